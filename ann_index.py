@@ -0,0 +1,95 @@
+import numpy as np
+
+
+def normalize_rows(X):
+    X = np.asarray(X, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return X / norms
+
+
+class IVFIndex:
+    """
+    Approximate cosine nearest neighbors with an inverted file (IVF) index.
+
+    Vectors are clustered with spherical k-means into n_lists lists; a query
+    only scans the n_probe lists whose centroids are closest to it. Raising
+    n_probe trades speed for recall, n_probe == n_lists is an exact search.
+
+    Has the fit/kneighbors interface of sklearn.neighbors.NearestNeighbors, so
+    it can be passed to ItemBasedFilter in its place.
+    """
+
+    def __init__(self, n_neighbors=50, n_lists=64, n_probe=8, n_iter=20, random_state=0):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def fit(self, X):
+        vectors = normalize_rows(X)
+        rng = np.random.default_rng(self.random_state)
+        n_lists = min(self.n_lists, len(vectors))
+
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            counts = np.bincount(assignment, minlength=n_lists)
+            # Re-seed empty lists with random vectors
+            empty = counts == 0
+            sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+            centroids = normalize_rows(sums)
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+
+        # Store the vectors grouped by list so each list is one contiguous slice
+        order = np.argsort(assignment, kind="stable")
+        self.centroids = centroids
+        self.ids = order
+        self.vectors = vectors[order]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_lists))))
+        return self
+
+    def params(self):
+        return {"n_neighbors": self.n_neighbors, "n_lists": self.n_lists, "n_probe": self.n_probe,
+                "n_iter": self.n_iter, "random_state": self.random_state}
+
+    def state(self):
+        return {"centroids": self.centroids, "ids": self.ids, "vectors": self.vectors, "offsets": self.offsets}
+
+    def load_state(self, state):
+        # Restore a fitted index, e.g. from memory-mapped arrays, without refitting
+        self.centroids = state["centroids"]
+        self.ids = state["ids"]
+        self.vectors = state["vectors"]
+        self.offsets = state["offsets"]
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        k = min(n_neighbors or self.n_neighbors, len(self.vectors))
+        queries = normalize_rows(X)
+        list_order = np.argsort(-(queries @ self.centroids.T), axis=1)
+        list_sizes = np.diff(self.offsets)
+
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        for row, query in enumerate(queries):
+            # Probe n_probe lists, or more if they hold fewer than k vectors
+            n_probe = max(self.n_probe, np.searchsorted(np.cumsum(list_sizes[list_order[row]]), k) + 1)
+            probed = list_order[row][:n_probe]
+            positions = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in probed])
+
+            candidate_distances = 1 - self.vectors[positions] @ query
+            if len(positions) > k:
+                top = np.argpartition(candidate_distances, k - 1)[:k]
+            else:
+                top = np.arange(len(positions))
+            top = top[np.argsort(candidate_distances[top], kind="stable")]
+            distances[row] = candidate_distances[top]
+            indices[row] = self.ids[positions[top]]
+
+        if return_distance:
+            return distances, indices
+        return indices
@@ -0,0 +1,81 @@
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+from ann_index import IVFIndex
+from item_based_filter import ItemBasedFilter
+
+
+def make_catalog(song_data, features, size, seed=0):
+    """
+    Grow the catalog feature matrix to the given size by jittering existing rows.
+
+    Args:
+    - song_data (pandas.DataFrame): Song data with the feature columns.
+    - features (list): Feature column names.
+    - size (int): Number of rows in the returned matrix.
+    - seed (int): Random seed.
+
+    Returns:
+    - numpy.ndarray: float32 feature matrix of shape (size, len(features)).
+    """
+    X = song_data[features].to_numpy(dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(X), size)
+    noise = rng.normal(0, 0.02, (size, X.shape[1])).astype(np.float32) * np.abs(X[rows]).clip(0.05)
+    return X[rows] + noise
+
+
+def recall_at_k(exact, approximate):
+    """
+    Compute the mean fraction of exact neighbors found by the approximate search.
+
+    Args:
+    - exact (numpy.ndarray): Exact neighbor indices, one row per query.
+    - approximate (numpy.ndarray): Approximate neighbor indices, one row per query.
+
+    Returns:
+    - float: Recall@K averaged over the queries.
+    """
+    hits = [len(set(e) & set(a)) / len(e) for e, a in zip(exact.tolist(), approximate.tolist())]
+    return float(np.mean(hits))
+
+
+def time_queries(index, queries, k):
+    start_time = time.time()
+    _, indices = index.kneighbors(queries, n_neighbors=k)
+    elapsed_time = time.time() - start_time
+    return indices, len(queries) / elapsed_time
+
+
+catalog_sizes = [2649, 114000]
+query_count = 1000
+k = 50
+ivf_settings = [(64, 1), (64, 4), (64, 16), (256, 4), (256, 16), (256, 64)]
+
+
+def main():
+    song_data = pd.read_csv("final_data/csv_filtered.csv")
+    features = ItemBasedFilter.default_features
+
+    for size in catalog_sizes:
+        X = make_catalog(song_data, features, size)
+        queries = X[np.random.default_rng(1).integers(0, size, query_count)]
+
+        exact = NearestNeighbors(n_neighbors=k, algorithm='auto', metric='cosine').fit(X)
+        exact_indices, exact_qps = time_queries(exact, queries, k)
+        print(f"catalog {size}: brute force {exact_qps:.0f} queries/s")
+
+        for n_lists, n_probe in ivf_settings:
+            start_time = time.time()
+            ivf = IVFIndex(n_neighbors=k, n_lists=n_lists, n_probe=n_probe).fit(X)
+            fit_time = time.time() - start_time
+            indices, qps = time_queries(ivf, queries, k)
+            print(f"catalog {size}: IVF n_lists={n_lists} n_probe={n_probe}: "
+                  f"recall@{k} {recall_at_k(exact_indices, indices):.3f}, {qps:.0f} queries/s, fit {fit_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
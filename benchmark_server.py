@@ -0,0 +1,75 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from server import read_request
+
+
+async def post(reader, writer, path, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    return await read_response(reader)
+
+
+async def read_response(reader):
+    # The status line and headers have the same shape as a request's
+    _, status, _, body = await read_request(reader)
+    return status, json.loads(body)
+
+
+async def run_client(requests, latencies, host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    for payload in requests:
+        start_time = time.perf_counter()
+        await post(reader, writer, "/recommend", payload)
+        latencies.append(time.perf_counter() - start_time)
+    writer.close()
+
+
+async def run_benchmark(playlists, concurrency, request_count, N, recommender, host, port):
+    requests = [{"tracks": playlists[i % len(playlists)], "n": N, "filter": recommender} for i in range(request_count)]
+    latencies = []
+    start_time = time.perf_counter()
+    await asyncio.gather(*[run_client(requests[i::concurrency], latencies, host, port) for i in range(concurrency)])
+    elapsed_time = time.perf_counter() - start_time
+
+    latencies = np.asarray(latencies) * 1000
+    print(f"{recommender}, {concurrency} clients: {request_count / elapsed_time:.1f} req/s, "
+          f"p50 {np.percentile(latencies, 50):.2f} ms, p99 {np.percentile(latencies, 99):.2f} ms")
+
+
+async def server_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b"GET /stats HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    await writer.drain()
+    _, stats = await read_response(reader)
+    writer.close()
+    return stats
+
+
+testing_playlist_file_path = "final_data/TestSet.json"
+# Start server.py first
+host = "127.0.0.1"
+port = 8000
+seed_count = 5
+N = 40
+request_count = 2000
+concurrency_levels = [1, 8, 64]
+
+
+def main():
+    with open(testing_playlist_file_path, 'r') as f:
+        playlists = [[track["track_uri"] for track in playlist["tracks"]][:seed_count] for playlist in json.load(f)["playlists"]]
+
+    for recommender in ("user", "item"):
+        for concurrency in concurrency_levels:
+            asyncio.run(run_benchmark(playlists, concurrency, request_count, N, recommender, host, port))
+    print("Server stats:", asyncio.run(server_stats(host, port)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+
+from load import intersected_keys, split_playlists
+from synthetic_data import zipf_names
+
+
+def make_names(count, seed=0):
+    return zipf_names(np.random.default_rng(seed), count, name_vocabulary).tolist()
+
+
+def make_slice(index, playlists_per_slice=1000):
+    names = make_names(playlists_per_slice, seed=index + 1)
+    first_pid = index * playlists_per_slice
+    return [{"name": name, "pid": first_pid + i, "num_tracks": 0, "tracks": []} for i, name in enumerate(names)]
+
+
+def split_playlists_scan(playlists, json_final):
+    # The previous implementation: scan json_final for every playlist
+    included_playlists = []
+    excluded_playlists = []
+    for playlist in playlists:
+        playlist_name = playlist.get("name", "")
+        if any(item["name"] == playlist_name for item in json_final["playlists"]):
+            included_playlists.append(playlist)
+        else:
+            excluded_playlists.append(playlist)
+    return included_playlists, excluded_playlists
+
+
+def time_split(slice_count, split):
+    elapsed_time = 0
+    included = 0
+    for index in range(slice_count):
+        playlists = make_slice(index)
+        start_time = time.time()
+        included_playlists, _ = split(playlists)
+        elapsed_time += time.time() - start_time
+        included += len(included_playlists)
+    return elapsed_time, included
+
+
+name_vocabulary = 200000
+slice_counts = [10, 100, 1000]
+# The challenge set holds 10k playlists. Its real pids are not slice pids, so pids are drawn from the slices of the
+# largest run to give the pid set matches to find
+json_final = {"playlists": [{"name": name, "pid": pid} for name, pid in
+                            zip(make_names(10000), np.random.default_rng(0).choice(max(slice_counts) * 1000, 10000, replace=False).tolist())]}
+# The scan is O(slice playlists x intersected playlists), only run it where it finishes
+scan_slice_count_max = 10
+
+
+def main():
+    start_time = time.time()
+    names = intersected_keys(json_final, "name")
+    pids = intersected_keys(json_final, "pid")
+    print(f"intersected lookup built in {time.time() - start_time:.4f} seconds")
+
+    for slice_count in slice_counts:
+        elapsed_time, included = time_split(slice_count, lambda playlists: split_playlists(playlists, names, "name"))
+        print(f"{slice_count} slices, name set: {elapsed_time:.4f} seconds, {included} included")
+
+        elapsed_time, included = time_split(slice_count, lambda playlists: split_playlists(playlists, pids, "pid"))
+        print(f"{slice_count} slices, pid set: {elapsed_time:.4f} seconds, {included} included")
+
+        if slice_count <= scan_slice_count_max:
+            elapsed_time, included = time_split(slice_count, lambda playlists: split_playlists_scan(playlists, json_final))
+            print(f"{slice_count} slices, name scan: {elapsed_time:.4f} seconds, {included} included")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import time
+
+import numpy as np
+import scipy
+
+import load
+from evaluation_metrics import EvaluationMetrics
+from hybrid_filter import HybridFilter
+from item_based_filter import ItemBasedFilter
+from matrix_factorization_filter import MatrixFactorizationFilter
+from sparse_user_based_filter import SparseUserBasedFilter
+from synthetic_data import SyntheticMPD
+from user_based_filter import UserBasedFilter
+
+
+class BenchmarkRecorder:
+    """
+    Times benchmark steps and keeps one machine-readable record per step.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.results = []
+
+    @contextlib.contextmanager
+    def measure(self, benchmark, playlists, items=None, quiet=True):
+        # items is the number of units processed (queries, slices...), for a rate next to the time
+        record = {"benchmark": benchmark, "playlists": playlists}
+        output = io.StringIO() if quiet else None
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+            yield record
+        record["seconds"] = time.perf_counter() - start_time
+        if items is not None:
+            record["items"] = items
+            record["items_per_second"] = items / max(record["seconds"], 1e-9)
+        self.results.append(record)
+        print(json.dumps(record))
+
+    def save(self, file_path):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        with open(file_path, 'w') as f:
+            json.dump({"environment": self.environment, "results": self.results}, f, indent=4)
+        print("Benchmark results saved to:", file_path)
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__,
+            "machine": platform.machine(), "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def query_seeds(arrays, query_count, seed_count):
+    # First seed_count tracks of the first query_count playlists, with the tracks held out for scoring
+    queries, held_out = [], []
+    for i in range(min(query_count, len(arrays))):
+        tracks = arrays.track_uris(i)
+        queries.append(tracks[:seed_count])
+        held_out.append(tracks[seed_count:])
+    return queries, held_out
+
+
+def benchmark_load(recorder, dataset, work_folder):
+    """
+    Time the load.py stages on the dataset written as MPD slice files.
+    """
+    playlist_count = dataset.playlist_count
+    slices_folder = os.path.join(work_folder, "completedataset")
+    adjusted_folder = os.path.join(work_folder, "complete_adjusted")
+    for folder in (slices_folder, adjusted_folder):
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+    os.makedirs(os.path.join(adjusted_folder, "included"))
+    os.makedirs(os.path.join(adjusted_folder, "excluded"))
+
+    with recorder.measure("generate.slices", playlist_count, dataset.slice_count()):
+        paths = dataset.write_slices(slices_folder)
+    csv_path = os.path.join(work_folder, "csv_filtered.csv")
+    dataset.write_catalog(csv_path)
+
+    with recorder.measure("load.build_csv_index", playlist_count):
+        csv_index = load.build_csv_index(load.load_90k_set(csv_path))
+
+    # Stand-in for the challenge set: the names of every tenth held-out playlist
+    _, _, _, names = dataset.slice_tracks(dataset.slice_count(), count=10000)
+    intersected = load.intersected_keys({"playlists": [{"name": name} for name in names[::10].tolist()]}, "name")
+    with recorder.measure("load.process_slice", playlist_count, len(paths)):
+        for path in paths:
+            base_name = os.path.splitext(os.path.basename(path))[0]
+            load.process_slice(path, csv_index, os.path.join(adjusted_folder, f"{base_name}_adjusted.json"),
+                               playlist_length_minimum=10, intersected=intersected,
+                               included_file=os.path.join(adjusted_folder, "included", f"{base_name}_adjusted_included.json"),
+                               excluded_file=os.path.join(adjusted_folder, "excluded", f"{base_name}_adjusted_excluded.json"))
+
+    shutil.rmtree(slices_folder)
+    shutil.rmtree(adjusted_folder)
+
+
+def recommend_in_batches(recommender, queries):
+    # Popular seeds share a large part of the playlists, so batch memory grows fast with the playlist count
+    recommendations = []
+    for start in range(0, len(queries), batch_size):
+        recommendations.extend(recommender.recommend_batch(queries[start:start + batch_size], N))
+    return recommendations
+
+
+def benchmark_filters(recorder, dataset, arrays, catalog, queries):
+    playlist_count = dataset.playlist_count
+    query_count = len(queries)
+
+    with recorder.measure("sparse_user_based.build", playlist_count):
+        sparse_user_based_filter = SparseUserBasedFilter(arrays)
+    with recorder.measure("sparse_user_based.recommend_songs", playlist_count, query_count):
+        for query in queries:
+            sparse_user_based_filter.recommend_songs(query, N)
+    with recorder.measure("sparse_user_based.recommend_batch", playlist_count, query_count):
+        user_recommendations = recommend_in_batches(sparse_user_based_filter, queries)
+
+    # The reference walks playlist dicts in Python, only run it where it finishes
+    if playlist_count <= reference_playlists_max:
+        with recorder.measure("user_based.build", playlist_count):
+            user_based_filter = UserBasedFilter(arrays)
+        reference_queries = queries[:reference_query_count]
+        with recorder.measure("user_based.recommend_songs", playlist_count, len(reference_queries)):
+            for query in reference_queries:
+                user_based_filter.recommend_songs(query, N)
+
+    with recorder.measure("item_based.build", playlist_count, len(catalog)):
+        item_based_filter = ItemBasedFilter(catalog)
+    with recorder.measure("item_based.recommend_songs", playlist_count, query_count):
+        for query in queries:
+            item_based_filter.recommend_songs(query, N)
+    with recorder.measure("item_based.recommend_batch", playlist_count, query_count):
+        recommend_in_batches(item_based_filter, queries)
+
+    hybrid_filter = HybridFilter({"User-based": sparse_user_based_filter, "Item-based": item_based_filter},
+                                 budgets={"User-based": 4 * N, "Item-based": 2 * N})
+    with recorder.measure("hybrid.recommend_batch", playlist_count, query_count):
+        recommend_in_batches(hybrid_filter, queries)
+
+    with recorder.measure("factorization.build", playlist_count):
+        factorization_filter = MatrixFactorizationFilter(arrays)
+    with recorder.measure("factorization.recommend_songs", playlist_count, query_count):
+        for query in queries:
+            factorization_filter.recommend_songs(query, N)
+    with recorder.measure("factorization.recommend_batch", playlist_count, query_count):
+        recommend_in_batches(factorization_filter, queries)
+    return user_recommendations
+
+
+def benchmark_metrics(recorder, playlist_count, held_out, recommendations):
+    query_count = len(held_out)
+    with recorder.measure("evaluation_metrics.per_call", playlist_count, query_count):
+        for actual, recommended in zip(held_out, recommendations):
+            EvaluationMetrics.precision(actual, recommended)
+            EvaluationMetrics.recall(actual, recommended)
+            EvaluationMetrics.f1_score(actual, recommended)
+            EvaluationMetrics.average_precision(actual, recommended)
+            EvaluationMetrics.reciprocal_rank(actual, recommended)
+    with recorder.measure("evaluation_metrics.batch", playlist_count, query_count):
+        actual_ids, recommended_ids = EvaluationMetrics.encode_lists(held_out, recommendations)
+        hits = EvaluationMetrics.hit_matrix(actual_ids, recommended_ids)
+        EvaluationMetrics.batch_metrics(hits, [len(actual) for actual in held_out], [len(recs) for recs in recommendations])
+
+
+playlist_counts = [10000, 100000, 1000000]
+# MPD-format JSON takes about 16 kB per playlist, so the load.py stages only run up to this size
+load_playlists_max = 100000
+reference_playlists_max = 100000
+query_count = 200
+reference_query_count = 20
+seed_count = 5
+N = 40
+batch_size = 10
+work_folder = "data/benchmark"
+results_file = "out/benchmarks.json"
+
+
+def main():
+    recorder = BenchmarkRecorder(environment())
+    for playlist_count in playlist_counts:
+        dataset = SyntheticMPD(playlist_count)
+        recorder.environment.setdefault("datasets", []).append(dataset.config())
+
+        if playlist_count <= load_playlists_max:
+            benchmark_load(recorder, dataset, work_folder)
+
+        with recorder.measure("generate.playlist_arrays", playlist_count):
+            arrays = dataset.playlist_arrays()
+            catalog = dataset.catalog()
+        # Queries come from held-out slices, as the test set does not overlap the eval set
+        held_out_slices = -(-query_count // dataset.playlists_per_slice) + 1
+        queries, held_out = query_seeds(dataset.playlist_arrays(dataset.slice_count(), held_out_slices), query_count, seed_count)
+
+        recommendations = benchmark_filters(recorder, dataset, arrays, catalog, queries)
+        benchmark_metrics(recorder, playlist_count, held_out, recommendations)
+
+    recorder.save(results_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import json
+import os
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+def load_track_ids(csv_path):
+    """
+    Load the track ids of the song catalog.
+
+    Args:
+    - csv_path (str): Path to the csv_filtered CSV file.
+
+    Returns:
+    - list: Track ids in catalog order.
+    """
+    return pd.read_csv(csv_path, usecols=["track_id"])["track_id"].tolist()
+
+
+def load_playlist_matrix(json_files, track_to_id):
+    """
+    Build a binary playlist x track matrix from one or more playlist JSON files.
+
+    Files are read one at a time, so only the sparse matrix is held in memory.
+    Tracks that are not in the catalog are skipped.
+
+    Args:
+    - json_files (list): Paths to JSON files containing playlists.
+    - track_to_id (dict): Mapping from track id to catalog column.
+
+    Returns:
+    - scipy.sparse.csr_matrix: Playlist x track matrix with ones for membership.
+    """
+    indices = []
+    indptr = [0]
+    for json_file in json_files:
+        print("Reading playlists from:", json_file)
+        with open(json_file, 'r') as f:
+            json_data = json.load(f)
+        for playlist in json_data["playlists"]:
+            columns = {track_to_id[track["track_uri"]] for track in playlist["tracks"] if track["track_uri"] in track_to_id}
+            indices.extend(sorted(columns))
+            indptr.append(len(indices))
+
+    data = np.ones(len(indices), dtype=np.float32)
+    return csr_matrix((data, np.asarray(indices, dtype=np.int32), np.asarray(indptr, dtype=np.int64)),
+                      shape=(len(indptr) - 1, len(track_to_id)))
+
+
+# Matrices shared with the worker processes, set by init_worker
+_playlist_matrix = None
+_track_matrix = None
+_track_counts = None
+
+
+def init_worker(playlist_matrix, track_matrix, track_counts):
+    global _playlist_matrix, _track_matrix, _track_counts
+    _playlist_matrix = playlist_matrix
+    _track_matrix = track_matrix
+    _track_counts = track_counts
+
+
+def compute_neighbor_chunk(args):
+    """
+    Compute the top-K neighbors for a contiguous range of tracks.
+
+    Args:
+    - args (tuple): (start, end, k, similarity) with similarity one of
+      "cooccurrence", "cosine" or "jaccard".
+
+    Returns:
+    - tuple: (start, neighbors, scores) with neighbors an int32 (end - start, k)
+      array padded with -1 and scores the matching float32 array.
+    """
+    start, end, k, similarity = args
+    cooccurrence = _track_matrix[start:end].dot(_playlist_matrix).tocsr()
+
+    neighbors = np.full((end - start, k), -1, dtype=np.int32)
+    scores = np.zeros((end - start, k), dtype=np.float32)
+    for row in range(end - start):
+        track = start + row
+        columns = cooccurrence.indices[cooccurrence.indptr[row]:cooccurrence.indptr[row + 1]]
+        counts = cooccurrence.data[cooccurrence.indptr[row]:cooccurrence.indptr[row + 1]]
+        keep = columns != track
+        columns, counts = columns[keep], counts[keep]
+        if len(columns) == 0:
+            continue
+
+        if similarity == "cosine":
+            values = counts / np.sqrt(_track_counts[track] * _track_counts[columns])
+        elif similarity == "jaccard":
+            values = counts / (_track_counts[track] + _track_counts[columns] - counts)
+        else:
+            values = counts
+
+        if len(values) > k:
+            top = np.argpartition(-values, k - 1)[:k]
+        else:
+            top = np.arange(len(values))
+        # Highest score first, lower track id first on ties
+        top = top[np.lexsort((columns[top], -values[top]))]
+        neighbors[row, :len(top)] = columns[top]
+        scores[row, :len(top)] = values[top]
+
+    return start, neighbors, scores
+
+
+def build_neighbor_table(playlist_matrix, k=100, similarity="cooccurrence", chunk_size=1000, workers=1):
+    """
+    Compute the top-K item-item neighbor table for every track.
+
+    Args:
+    - playlist_matrix (scipy.sparse.csr_matrix): Binary playlist x track matrix.
+    - k (int): Number of neighbors kept per track.
+    - similarity (str): "cooccurrence", "cosine" or "jaccard".
+    - chunk_size (int): Number of tracks computed per task.
+    - workers (int): Number of worker processes, 1 computes in this process.
+
+    Returns:
+    - tuple: (neighbors, scores) arrays of shape (n_tracks, k).
+    """
+    if similarity not in ("cooccurrence", "cosine", "jaccard"):
+        raise ValueError(f"Unknown similarity: {similarity}")
+
+    n_tracks = playlist_matrix.shape[1]
+    track_matrix = playlist_matrix.T.tocsr()
+    track_counts = np.asarray(playlist_matrix.sum(axis=0), dtype=np.float32).ravel()
+    tasks = [(start, min(start + chunk_size, n_tracks), k, similarity) for start in range(0, n_tracks, chunk_size)]
+
+    neighbors = np.full((n_tracks, k), -1, dtype=np.int32)
+    scores = np.zeros((n_tracks, k), dtype=np.float32)
+
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(playlist_matrix, track_matrix, track_counts)) as pool:
+            results = pool.imap_unordered(compute_neighbor_chunk, tasks)
+            for start, chunk_neighbors, chunk_scores in results:
+                neighbors[start:start + len(chunk_neighbors)] = chunk_neighbors
+                scores[start:start + len(chunk_scores)] = chunk_scores
+                print(f"Neighbors computed for tracks {start}-{start + len(chunk_neighbors)}", end='\r')
+    else:
+        init_worker(playlist_matrix, track_matrix, track_counts)
+        for task in tasks:
+            start, chunk_neighbors, chunk_scores = compute_neighbor_chunk(task)
+            neighbors[start:start + len(chunk_neighbors)] = chunk_neighbors
+            scores[start:start + len(chunk_scores)] = chunk_scores
+            print(f"Neighbors computed for tracks {start}-{start + len(chunk_neighbors)}", end='\r')
+    print()
+
+    return neighbors, scores
+
+
+def save_neighbor_table(output_file, track_ids, neighbors, scores, similarity):
+    """
+    Save a neighbor table to an .npz file.
+
+    Args:
+    - output_file (str): Path to the output .npz file.
+    - track_ids (list): Track ids in catalog order.
+    - neighbors (numpy.ndarray): Neighbor column ids, -1 for padding.
+    - scores (numpy.ndarray): Neighbor similarity scores.
+    - similarity (str): Name of the similarity used.
+
+    Returns:
+    - None
+    """
+    output_folder = os.path.dirname(output_file)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+    np.savez(output_file, track_ids=np.asarray(track_ids, dtype=str), neighbors=neighbors, scores=scores,
+             similarity=np.asarray(similarity))
+    print("Neighbor table saved to:", output_file)
+
+
+csv_file = "final_data/csv_filtered.csv"
+# EvalSet.json, or the data/complete_adjusted slices to use every MPD slice
+playlist_files = ["final_data/EvalSet.json"]
+neighbor_table_file = "final_data/neighbors.npz"
+neighbor_count = 100
+neighbor_similarity = "cooccurrence"
+neighbor_chunk_size = 1000
+neighbor_workers = os.cpu_count() or 1
+
+
+def main():
+    track_ids = load_track_ids(csv_file)
+    track_to_id = {track_id: i for i, track_id in enumerate(track_ids)}
+
+    playlist_matrix = load_playlist_matrix(playlist_files, track_to_id)
+    print("Playlists loaded:", playlist_matrix.shape[0])
+
+    neighbors, scores = build_neighbor_table(playlist_matrix, neighbor_count, neighbor_similarity,
+                                             neighbor_chunk_size, neighbor_workers)
+    save_neighbor_table(neighbor_table_file, track_ids, neighbors, scores, neighbor_similarity)
+
+
+if __name__ == "__main__":
+    main()
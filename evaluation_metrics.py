@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class EvaluationMetrics:
     @staticmethod
     def precision(actual, recommended):
@@ -104,4 +107,98 @@ class EvaluationMetrics:
         float: Mean Reciprocal Rank value.
         """
         rr_list = [EvaluationMetrics.reciprocal_rank(a, r) for a, r in zip(actual, recommended)]
-        return sum(rr_list) / len(rr_list) if rr_list else 0
\ No newline at end of file
+        return sum(rr_list) / len(rr_list) if rr_list else 0
+
+    @staticmethod
+    def encode_lists(actual, recommended):
+        """
+        Encode lists of items as padded integer arrays for batch_metrics.
+
+        Parameters:
+        actual (list): List of actual item lists, one per playlist.
+        recommended (list): List of recommended item lists, one per playlist.
+
+        Returns:
+        tuple: (actual_ids, recommended_ids) int64 arrays padded with -1.
+        """
+        item_ids = {}
+
+        def pad(lists):
+            width = max((len(items) for items in lists), default=0)
+            ids = np.full((len(lists), width), -1, dtype=np.int64)
+            for row, items in enumerate(lists):
+                ids[row, :len(items)] = [item_ids.setdefault(item, len(item_ids)) for item in items]
+            return ids
+
+        return pad(actual), pad(recommended)
+
+    @staticmethod
+    def hit_matrix(actual_ids, recommended_ids):
+        """
+        Mark which recommended items are relevant.
+
+        Parameters:
+        actual_ids (numpy.ndarray): Actual item ids per playlist, padded with -1.
+        recommended_ids (numpy.ndarray): Recommended item ids per playlist, padded with -1.
+
+        Returns:
+        numpy.ndarray: Boolean matrix shaped like recommended_ids.
+        """
+        n_items = max(actual_ids.max(initial=-1), recommended_ids.max(initial=-1)) + 2
+        rows = np.arange(len(recommended_ids))[:, None]
+        # Key every id by its playlist, so one isin covers the whole run
+        actual_keys = (rows * n_items + actual_ids)[actual_ids >= 0]
+        hits = np.isin(rows * n_items + recommended_ids, actual_keys)
+        return hits & (recommended_ids >= 0)
+
+    @staticmethod
+    def batch_metrics(hits, actual_counts, recommended_counts=None, cutoff=None):
+        """
+        Compute precision, recall, F1, average precision, reciprocal rank and NDCG for a whole run.
+
+        Gives the same values as the per-call functions, assuming recommended
+        lists hold no duplicates. Pass hits[:, :K], the matching counts and
+        cutoff=K for metrics at cutoff K.
+
+        Parameters:
+        hits (numpy.ndarray): Boolean hit matrix, one row per playlist (see hit_matrix).
+        actual_counts (numpy.ndarray): Number of actual items per playlist.
+        recommended_counts (numpy.ndarray): Number of recommended items per playlist,
+            hits.shape[1] for every row if None.
+        cutoff (int): Length of the ideal ranking for NDCG, which holds min(actual, cutoff)
+            relevant items however short the recommended list is; hits.shape[1] if None.
+
+        Returns:
+        dict: Metric name -> array with one value per playlist.
+        """
+        hits = np.asarray(hits, dtype=bool)
+        n_playlists, width = hits.shape
+        actual_counts = np.asarray(actual_counts, dtype=np.float64)
+        if recommended_counts is None:
+            recommended_counts = np.full(n_playlists, width)
+        recommended_counts = np.minimum(np.asarray(recommended_counts, dtype=np.float64), width)
+
+        ranks = np.arange(1, width + 1)
+        hit_counts = hits.sum(axis=1)
+        cumulative_hits = np.cumsum(hits, axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(recommended_counts > 0, hit_counts / recommended_counts, 0)
+            recall = np.where(actual_counts > 0, hit_counts / actual_counts, 0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0)
+            average_precision = np.where(actual_counts > 0, (hits * cumulative_hits / ranks).sum(axis=1) / actual_counts, 0)
+
+            # argmax has nothing to search when every list is empty
+            first_hit = np.argmax(hits, axis=1) if width > 0 else np.zeros(n_playlists, dtype=np.int64)
+            reciprocal_rank = np.where(hit_counts > 0, 1 / (first_hit + 1), 0)
+
+            if cutoff is None:
+                cutoff = width
+            discounts = 1 / np.log2(np.arange(1, max(width, cutoff) + 1) + 1)
+            dcg = (hits * discounts[:width]).sum(axis=1)
+            ideal_counts = np.minimum(actual_counts, cutoff).astype(np.int64)
+            ideal_dcg = np.concatenate(([0], np.cumsum(discounts)))[ideal_counts]
+            ndcg = np.where(ideal_dcg > 0, dcg / ideal_dcg, 0)
+
+        return {"precision": precision, "recall": recall, "f1_score": f1, "average_precision": average_precision,
+                "reciprocal_rank": reciprocal_rank, "ndcg": ndcg}
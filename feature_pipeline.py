@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+default_features = ['danceability', 'explicit', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence']
+
+
+class FeaturePipeline:
+    """
+    Turns song data into the float32 feature matrix used by ItemBasedFilter.
+
+    Numeric features (e.g. default_features plus 'tempo', 'key', 'mode') are
+    standardized to zero mean and unit variance, categorical columns such as
+    'track_genre' are one-hot encoded. weights maps a column name to a factor
+    applied after scaling; for a one-hot column it applies to all its columns.
+    """
+
+    def __init__(self, features=None, one_hot=(), weights=None, standardize=True):
+        self.features = list(default_features if features is None else features)
+        self.one_hot = list(one_hot)
+        self.weights = dict(weights or {})
+        self.standardize = standardize
+
+    def config(self):
+        return {"features": self.features, "one_hot": self.one_hot, "weights": self.weights, "standardize": self.standardize}
+
+    def fit(self, data):
+        X = data[self.features].to_numpy(dtype=np.float64)
+        self.means = X.mean(axis=0) if self.standardize else np.zeros(X.shape[1])
+        stds = X.std(axis=0) if self.standardize else np.ones(X.shape[1])
+        stds[stds == 0] = 1
+        self.stds = stds
+        self.categories = {column: sorted(data[column].astype(str).unique()) for column in self.one_hot}
+        return self
+
+    def transform(self, data):
+        X = (data[self.features].to_numpy(dtype=np.float64) - self.means) / self.stds
+        X = X * np.asarray([self.weights.get(feature, 1) for feature in self.features])
+        blocks = [X]
+        for column in self.one_hot:
+            categories = pd.Categorical(data[column].astype(str), categories=self.categories[column])
+            one_hot = np.zeros((len(data), len(self.categories[column])))
+            known = categories.codes >= 0
+            one_hot[np.flatnonzero(known), categories.codes[known]] = self.weights.get(column, 1)
+            blocks.append(one_hot)
+        return np.ascontiguousarray(np.hstack(blocks), dtype=np.float32)
+
+    def fit_transform(self, data):
+        return self.fit(data).transform(data)
+
+    def state(self):
+        return {"means": self.means, "stds": self.stds,
+                "categories": json.dumps(self.categories)}
+
+    def load_state(self, state):
+        self.means = state["means"]
+        self.stds = state["stds"]
+        self.categories = json.loads(str(state["categories"]))
+        return self
+
+
+def file_hash(file_path):
+    """
+    Compute the SHA-256 hash of a file's content.
+
+    Args:
+    - file_path (str): Path to the file.
+
+    Returns:
+    - str: Hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_features(csv_path, pipeline, cache_folder="cache", nrows=None):
+    """
+    Load the transformed feature matrix of a song CSV, using a disk cache.
+
+    The cache key combines the CSV content hash, the pipeline configuration
+    and nrows. On a hit neither the CSV is parsed nor the pipeline refit.
+
+    Args:
+    - csv_path (str): Path to the song CSV file.
+    - pipeline (FeaturePipeline): Pipeline to fit, restored from cache on a hit.
+    - cache_folder (str): Folder holding the cached .npz files.
+    - nrows (int): Number of CSV rows to read, None for all.
+
+    Returns:
+    - tuple: (track_ids, feature_matrix) with feature_matrix a float32 array.
+    """
+    key_source = json.dumps({"csv": file_hash(csv_path), "pipeline": pipeline.config(), "nrows": nrows}, sort_keys=True)
+    key = hashlib.sha256(key_source.encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_folder, f"features_{key}.npz")
+
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            pipeline.load_state(cached)
+            return cached["track_ids"], cached["feature_matrix"]
+
+    data = pd.read_csv(csv_path, nrows=nrows)
+    feature_matrix = pipeline.fit_transform(data)
+    track_ids = data['track_id'].to_numpy(dtype=str)
+
+    os.makedirs(cache_folder, exist_ok=True)
+    # Write to a temporary file first so a crash never leaves a partial cache entry
+    temporary_file = cache_file + ".tmp.npz"
+    np.savez(temporary_file, track_ids=track_ids, feature_matrix=feature_matrix, **pipeline.state())
+    os.replace(temporary_file, cache_file)
+    return track_ids, feature_matrix
@@ -0,0 +1,102 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+class HybridFilter:
+    """
+    Fuses the scored candidates of several filters into one ranking.
+
+    Every source filter is asked for budgets[name] candidates per playlist
+    through recommend_scored_batch, so the cost is that of the sources at
+    their budgets plus one merge over all candidates.
+
+    rank_fusion: a candidate gets weights[name] / (rank_fusion_k + rank) from
+    each source that lists it, rank counted from 1.
+    weighted: a candidate gets weights[name] times its score in each source
+    listing it, min-max normalized over that source's candidates for the playlist.
+
+    Ties go to the candidate listed first, in source order and then by rank.
+    """
+
+    aggregations = ('rank_fusion', 'weighted')
+    rank_fusion_k = 60
+
+    def __init__(self, filters, aggregation='rank_fusion', weights=None, budgets=None):
+        if aggregation not in self.aggregations:
+            raise ValueError(f"Unknown aggregation: {aggregation}")
+        # Name -> filter with recommend_scored_batch
+        self.filters = dict(filters)
+        self.aggregation = aggregation
+        self.weights = {name: 1.0 for name in self.filters}
+        self.weights.update(weights or {})
+        # Candidates per playlist asked from each source, None for N
+        self.budgets = {name: None for name in self.filters}
+        self.budgets.update(budgets or {})
+
+    @property
+    def fingerprint(self):
+        # Read from the sources on every use, so a source updated since, e.g. with add_playlists, changes it
+        fingerprints = [getattr(recommender, "fingerprint", None) for recommender in self.filters.values()]
+        if any(fingerprint is None for fingerprint in fingerprints):
+            return None
+        config = [list(self.filters), fingerprints, self.aggregation, self.weights, self.budgets, self.rank_fusion_k]
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def recommend_songs(self, playlist, N):
+        return self.recommend_batch([playlist], N)[0]
+
+    def recommend_batch(self, playlists, N):
+        return [tracks.tolist() for tracks, _ in self.recommend_scored_batch(playlists, N)]
+
+    def recommend_scored(self, playlist, N):
+        return self.recommend_scored_batch([playlist], N)[0]
+
+    def recommend_scored_batch(self, playlists, N):
+        """
+        Fused (tracks, scores) arrays per playlist, best first.
+        """
+        if N <= 0 or len(playlists) == 0:
+            return [(np.empty(0, dtype=str), np.empty(0)) for _ in playlists]
+        tracks, contributions, queries = [], [], []
+        for name, recommender in self.filters.items():
+            if self.weights[name] == 0:
+                continue
+            scored = recommender.recommend_scored_batch(playlists, self.budgets[name] or N)
+            lengths = np.asarray([len(source_tracks) for source_tracks, _ in scored], dtype=np.int64)
+            tracks.extend(np.asarray(source_tracks, dtype=str) for source_tracks, _ in scored)
+            scores = np.concatenate([np.asarray(source_scores, dtype=np.float64) for _, source_scores in scored])
+            contributions.append(self.weights[name] * self.normalize(scores, lengths))
+            queries.append(np.repeat(np.arange(len(playlists)), lengths))
+        tracks = np.concatenate(tracks or [np.empty(0, dtype=str)])
+        contributions = np.concatenate(contributions or [np.empty(0)])
+        queries = np.concatenate(queries or [np.empty(0, dtype=np.int64)])
+
+        # Sources have their own track ids, so candidates are merged on the URI
+        uris, track_ids = np.unique(tracks, return_inverse=True)
+        keys, first, inverse = np.unique(queries * len(uris) + track_ids, return_index=True, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions)
+        key_queries, key_tracks = keys // max(len(uris), 1), keys % max(len(uris), 1)
+
+        order = np.lexsort((first, -scores, key_queries))
+        key_queries, key_tracks, scores = key_queries[order], key_tracks[order], scores[order]
+        ranks = np.arange(len(order)) - np.searchsorted(key_queries, key_queries)
+        top = ranks < N
+        key_queries, key_tracks, scores = key_queries[top], key_tracks[top], scores[top]
+        bounds = np.searchsorted(key_queries, np.arange(1, len(playlists)))
+        return list(zip(np.split(uris[key_tracks], bounds), np.split(scores, bounds)))
+
+    def normalize(self, scores, lengths):
+        # Scores of one source, lengths[i] of them for playlist i, each playlist's best first
+        starts = np.cumsum(lengths) - lengths
+        owners = np.repeat(np.arange(len(lengths)), lengths)
+        if self.aggregation == 'rank_fusion':
+            return 1 / (self.rank_fusion_k + np.arange(1, len(scores) + 1) - starts[owners])
+        listed = lengths > 0
+        low, high = np.zeros(len(lengths)), np.zeros(len(lengths))
+        low[listed] = np.minimum.reduceat(scores, starts[listed])
+        high[listed] = np.maximum.reduceat(scores, starts[listed])
+        spans = (high - low)[owners]
+        # A playlist whose candidates all score the same gets 1 for each
+        return np.divide(scores - low[owners], spans, out=np.ones_like(scores), where=spans > 0)
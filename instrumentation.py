@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+# Histogram bucket upper bounds, cumulative as in Prometheus; values above the last go to +Inf
+second_buckets = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+count_buckets = (0, 1, 5, 10, 50, 100, 500, 1e3, 5e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7)
+byte_buckets = tuple(float(4 ** i) for i in range(5, 16))
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram with count, sum, min and max.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = np.asarray(bounds, dtype=np.float64)
+        self.bucket_counts = np.zeros(len(bounds) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value):
+        # Bucket i holds values in (bounds[i - 1], bounds[i]]
+        self.bucket_counts[np.searchsorted(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile, capped by the largest value seen
+        if self.count == 0:
+            return None
+        bucket = int(np.searchsorted(np.cumsum(self.bucket_counts), q * self.count))
+        return min(float(self.bounds[bucket]), self.max) if bucket < len(self.bounds) else self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+                "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(bound) for bound in self.bounds.tolist()] + ["+Inf"],
+                                    np.cumsum(self.bucket_counts).tolist()))}
+
+
+class Profiler:
+    """
+    Collects per-stage timings, candidate counts and memory of the recommendation path.
+
+    Instrumented code holds a profiler in a profiler attribute that is None
+    by default, and only checks it against None when profiling is off. Set
+    the class attribute to profile every instance, e.g.
+    ItemBasedFilter.profiler = Profiler() before building the filter also
+    profiles fit(). Stages are named "<component>.<stage>", e.g.
+    "user_based.seed_lookup", and each gets a histogram.
+
+    With track_memory, the peak of traced allocations during each stage is
+    recorded through tracemalloc, which slows Python allocations down; the
+    numbers are approximate when several threads recommend at once.
+    """
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counts = {}
+        self.memory = {}
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def timer(self, component):
+        return StageTimer(self, component)
+
+    def observe(self, histograms, bounds, name, value):
+        with self.lock:
+            histogram = histograms.get(name)
+            if histogram is None:
+                histogram = histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.timings, self.counts, self.memory = {}, {}, {}
+
+    def report(self):
+        with self.lock:
+            return {"seconds": {name: histogram.to_dict() for name, histogram in sorted(self.timings.items())},
+                    "counts": {name: histogram.to_dict() for name, histogram in sorted(self.counts.items())},
+                    "memory_bytes": {name: histogram.to_dict() for name, histogram in sorted(self.memory.items())}}
+
+    def summary(self):
+        """
+        One line per stage: calls, mean, p50 and p99 time, and the mean of its counts.
+        """
+        report = self.report()
+        lines = []
+        for name, timing in report["seconds"].items():
+            line = (f"{name}: {timing['count']} calls, mean {timing['mean'] * 1000:.3f} ms, "
+                    f"p50 {timing['p50'] * 1000:.3f} ms, p99 {timing['p99'] * 1000:.3f} ms")
+            memory = report["memory_bytes"].get(name)
+            if memory is not None:
+                line += f", peak {memory['max'] / 2 ** 20:.2f} MiB"
+            lines.append(line)
+        for name, counts in report["counts"].items():
+            lines.append(f"{name}: mean {counts['mean']:.1f}, max {counts['max']:.0f}")
+        return "\n".join(lines)
+
+    def save_json(self, file_path):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        with open(file_path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+    def prometheus_text(self, prefix="recommendation"):
+        """
+        The histograms in the Prometheus text exposition format.
+        """
+        families = (("stage_seconds", "Time spent in each stage.", self.timings),
+                    ("stage_count", "Sizes counted in each stage, e.g. candidates.", self.counts),
+                    ("stage_memory_bytes", "Peak traced allocations in each stage.", self.memory))
+        lines = []
+        with self.lock:
+            for family, description, histograms in families:
+                if not histograms:
+                    continue
+                metric = f"{prefix}_{family}"
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in sorted(histograms.items()):
+                    label = json.dumps(name)
+                    for bound, count in zip(histogram.bounds.tolist() + ["+Inf"], np.cumsum(histogram.bucket_counts).tolist()):
+                        lines.append(f'{metric}_bucket{{stage={label},le="{bound}"}} {count}')
+                    lines.append(f"{metric}_sum{{stage={label}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{stage={label}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def save_prometheus(self, file_path):
+        # Written for the node exporter textfile collector: write to a temporary file, then rename
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        with open(file_path + ".tmp", 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(file_path + ".tmp", file_path)
+
+
+class StageTimer:
+    """
+    Times consecutive stages of one call: each lap() closes the stage that
+    started at the previous lap, and finish() also records the whole call.
+    """
+
+    def __init__(self, profiler, component):
+        self.profiler = profiler
+        self.component = component
+        if profiler.track_memory:
+            tracemalloc.reset_peak()
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        self.start_time = self.lap_time = time.perf_counter()
+
+    def lap(self, stage, **counts):
+        """
+        Record the time since the previous lap as stage, with optional counts such as candidates=len(candidates).
+        """
+        now = time.perf_counter()
+        profiler = self.profiler
+        name = f"{self.component}.{stage}"
+        profiler.observe(profiler.timings, second_buckets, name, now - self.lap_time)
+        for count_name, value in counts.items():
+            profiler.observe(profiler.counts, count_buckets, f"{self.component}.{count_name}", value)
+        if profiler.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            profiler.observe(profiler.memory, byte_buckets, name, max(peak - self.memory_start, 0))
+            tracemalloc.reset_peak()
+            self.memory_start = current
+        # The profiler's own work is left out of the next stage
+        self.lap_time = time.perf_counter()
+
+    def finish(self, stage, **counts):
+        self.lap(stage, **counts)
+        self.profiler.observe(self.profiler.timings, second_buckets, f"{self.component}.total", self.lap_time - self.start_time)
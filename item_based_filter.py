@@ -1,30 +1,308 @@
+import numpy as np
+import pandas as pd
 from sklearn.neighbors import NearestNeighbors
 
+from ann_index import IVFIndex, normalize_rows
+from feature_pipeline import default_features, load_features
+from model_store import load_model, save_model
+from recommendation_cache import LRUCache
+
 class ItemBasedFilter:
-    def __init__(self, data):
+    default_features = default_features
+    # first: neighbors of the seed that comes first in the song data
+    # centroid: neighbors of the mean of the normalized seed vectors
+    # rank_fusion: reciprocal rank fusion of every seed's neighbor list
+    # distance_weighted: every seed votes for its neighbors with their cosine similarity
+    aggregations = ('first', 'centroid', 'rank_fusion', 'distance_weighted')
+    rank_fusion_k = 60
+    seed_cache = None
+    # Cached neighbor lists are fetched with k rounded up to a multiple of this, so the k of nearby seed counts and N reuse them
+    seed_cache_k_step = 64
+    # Neighbors fetched past k and reranked on float64 distances, so the index's float32 rounding, which depends on
+    # the batch, cannot change which neighbors make the cut
+    rerank_margin = 16
+    rerank_block_size = 1024
+    # Optional instrumentation.Profiler for fit and recommend_batch; set on the class to also profile the fit in __init__
+    profiler = None
+
+    def __init__(self, data, nearest_neighbors=None, aggregation='first', pipeline=None, feature_matrix=None):
+        if aggregation not in self.aggregations:
+            raise ValueError(f"Unknown aggregation: {aggregation}")
         self.data = data
-        self.features = ['danceability', 'explicit', 'energy', 'loudness', 'speechiness', 'acousticness', 'instrumentalness', 'liveness', 'valence']
-        self.nearest_neighbors = NearestNeighbors(n_neighbors=50, algorithm='auto', metric='cosine')
+        self.features = list(self.default_features if pipeline is None else pipeline.features)
+        self.aggregation = aggregation
+        # Optional feature_pipeline.FeaturePipeline, or an already transformed matrix aligned with data
+        self.pipeline = pipeline
+        self.precomputed_features = feature_matrix
+        # Any index with the NearestNeighbors fit/kneighbors interface, e.g. ann_index.IVFIndex
+        if nearest_neighbors is None:
+            nearest_neighbors = NearestNeighbors(n_neighbors=50, algorithm='auto', metric='cosine')
+        self.nearest_neighbors = nearest_neighbors
         self.fit()
 
+    @classmethod
+    def from_csv(cls, csv_path, pipeline, cache_folder="cache", nrows=None, **kwargs):
+        """
+        Build the filter from a song CSV through the cached feature pipeline.
+
+        When the CSV and pipeline are unchanged since the last run, the cached
+        matrix is loaded and the CSV is not parsed.
+        """
+        track_ids, feature_matrix = load_features(csv_path, pipeline, cache_folder, nrows)
+        return cls(pd.DataFrame({'track_id': track_ids}), pipeline=pipeline, feature_matrix=feature_matrix, **kwargs)
+
     def fit(self):
-        X = self.data[self.features]
-        self.nearest_neighbors.fit(X)
+        # Contiguous float32 features and a track_id -> row lookup, so queries never touch the DataFrame
+        timer = self.profiler.timer("item_based_fit") if self.profiler is not None else None
+        if self.precomputed_features is not None:
+            self.feature_matrix = np.ascontiguousarray(self.precomputed_features, dtype=np.float32)
+        elif self.pipeline is not None:
+            self.feature_matrix = self.pipeline.fit_transform(self.data)
+        else:
+            self.feature_matrix = np.ascontiguousarray(self.data[self.features].to_numpy(dtype=np.float32))
+        if timer is not None:
+            timer.lap("features", rows=len(self.feature_matrix))
+        self.track_ids = self.data['track_id'].to_numpy()
+        self.track_rows = {}
+        for row, track_id in enumerate(self.track_ids.tolist()):
+            self.track_rows.setdefault(track_id, row)
+        # First row of each row's track, so duplicate rows count as one track
+        self.row_tracks = np.asarray([self.track_rows[track_id] for track_id in self.track_ids.tolist()], dtype=np.int64)
+        self.row_norms = np.linalg.norm(self.feature_matrix.astype(np.float64), axis=1)
+        if timer is not None:
+            timer.lap("track_lookup", tracks=len(self.track_rows))
+        self.nearest_neighbors.fit(self.feature_matrix)
+        if self.seed_cache is not None:
+            self.seed_cache.clear()
+        if timer is not None:
+            timer.finish("index_fit")
+
+    def save(self, folder):
+        """
+        Save the feature matrix and neighbor structures so other processes can memory-map them with load().
+        """
+        arrays = {"feature_matrix": self.feature_matrix, "track_ids": self.track_ids.astype(str), "row_tracks": self.row_tracks}
+        meta = {"model": type(self).__name__, "features": self.features, "aggregation": self.aggregation,
+                "fingerprint": getattr(self, "fingerprint", None)}
+        if isinstance(self.nearest_neighbors, IVFIndex):
+            arrays.update({f"ivf_{name}": array for name, array in self.nearest_neighbors.state().items()})
+            meta["index"] = dict(self.nearest_neighbors.params(), type="ivf")
+        else:
+            # Brute-force NearestNeighbors only keeps the feature matrix, refitting it is free
+            meta["index"] = {"type": "sklearn", "n_neighbors": self.nearest_neighbors.n_neighbors,
+                             "algorithm": self.nearest_neighbors.algorithm, "metric": self.nearest_neighbors.metric}
+        save_model(folder, arrays, meta)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Load a filter saved with save(). The song DataFrame is not restored, data is None.
+        """
+        arrays, meta = load_model(folder, mmap)
+        item_based_filter = cls.__new__(cls)
+        item_based_filter.data = None
+        item_based_filter.features = meta["features"]
+        item_based_filter.aggregation = meta["aggregation"]
+        item_based_filter.pipeline = None
+        item_based_filter.precomputed_features = None
+        item_based_filter.fingerprint = meta["fingerprint"]
+        item_based_filter.feature_matrix = arrays["feature_matrix"]
+        item_based_filter.track_ids = arrays["track_ids"]
+        item_based_filter.row_tracks = arrays["row_tracks"]
+        item_based_filter.track_rows = {}
+        for row, track_id in enumerate(item_based_filter.track_ids.tolist()):
+            item_based_filter.track_rows.setdefault(track_id, row)
+        item_based_filter.row_norms = np.linalg.norm(np.asarray(item_based_filter.feature_matrix, dtype=np.float64), axis=1)
+
+        index = dict(meta["index"])
+        if index.pop("type") == "ivf":
+            state = {name[len("ivf_"):]: array for name, array in arrays.items() if name.startswith("ivf_")}
+            item_based_filter.nearest_neighbors = IVFIndex(**index).load_state(state)
+        else:
+            item_based_filter.nearest_neighbors = NearestNeighbors(**index).fit(item_based_filter.feature_matrix)
+        return item_based_filter
+
+    def seed_rows(self, playlists):
+        # Rows of the known seeds, once per track, with the playlist they belong to
+        rows = []
+        queries = []
+        for query, playlist in enumerate(playlists):
+            playlist_rows = dict.fromkeys(self.track_rows[track_id] for track_id in playlist if track_id in self.track_rows)
+            rows.extend(playlist_rows)
+            queries.extend([query] * len(playlist_rows))
+        return np.asarray(rows, dtype=np.int64), np.asarray(queries, dtype=np.int64)
+
+    def n_neighbors(self, playlists, N):
+        # Per playlist, enough neighbors to fill N after its seeds are excluded
+        lengths = np.asarray([len(playlist) for playlist in playlists], dtype=np.int64)
+        return np.minimum(len(self.feature_matrix), np.maximum(self.nearest_neighbors.n_neighbors, N + lengths))
+
+    def enable_seed_cache(self, max_entries=100000, max_bytes=1 << 30):
+        """
+        Cache the neighbor list of each query row, so seeds shared by many playlists are searched once.
+
+        Covers every aggregation but centroid, whose query depends on all seeds.
+        self.seed_cache.stats() reports hits, misses and bytes.
+        """
+        self.seed_cache = LRUCache(max_entries, max_bytes)
+        return self
+
+    def kneighbors(self, query_features, k):
+        """
+        The k nearest rows of each query as (distances, indices), closest first and lower row on equal distances.
+
+        The index's candidates, rerank_margin more than k, are reranked on
+        cosine distances recomputed per (query, row) in float64. These do not
+        depend on the batch or on k, so batched, single and cached queries get
+        the same lists.
+        """
+        fetch_k = min(k + self.rerank_margin, len(self.feature_matrix))
+        # Rows in ascending order, so a stable sort on distance breaks ties on the row
+        indices = np.sort(self.nearest_neighbors.kneighbors(query_features, n_neighbors=fetch_k, return_distance=False), axis=1)
+        queries = np.asarray(query_features, dtype=np.float64)
+        distances = np.empty(indices.shape)
+        for start in range(0, len(queries), self.rerank_block_size):
+            block = slice(start, start + self.rerank_block_size)
+            dots = np.einsum("qf,qkf->qk", queries[block], self.feature_matrix[indices[block]].astype(np.float64))
+            norms = np.linalg.norm(queries[block], axis=1)[:, None] * self.row_norms[indices[block]]
+            # A zero vector is at distance 1 from everything, as in sklearn's cosine metric
+            distances[block] = 1 - np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def cached_kneighbors(self, query_rows, list_k):
+        # Neighbor lists keyed on the row: the longest list fetched so far serves any k up to its length,
+        # only a larger k fetches again. Lists come back padded to the largest k; callers mask each to its k
+        wanted = {}
+        for row, k in zip(query_rows.tolist(), list_k.tolist()):
+            wanted[row] = max(wanted.get(row, 0), k)
+        entries = {}
+        missing = []
+        for row, k in wanted.items():
+            entries[row] = self.seed_cache.get(row, accept=lambda entry, k=k: len(entry[1]) >= k)
+            if entries[row] is None:
+                missing.append(row)
+        if missing:
+            missing_k = -(-max(wanted[row] for row in missing) // self.seed_cache_k_step) * self.seed_cache_k_step
+            missing_k = min(missing_k, len(self.feature_matrix))
+            distances, indices = self.kneighbors(self.feature_matrix[missing], missing_k)
+            for i, row in enumerate(missing):
+                entries[row] = (distances[i].copy(), indices[i].copy())
+                self.seed_cache.put(row, entries[row])
+
+        distances = np.ones((len(query_rows), list_k.max()), dtype=np.float64)
+        indices = np.zeros((len(query_rows), list_k.max()), dtype=np.int64)
+        for i, (row, k) in enumerate(zip(query_rows.tolist(), list_k.tolist())):
+            row_distances, row_indices = entries[row]
+            distances[i, :k] = row_distances[:k]
+            indices[i, :k] = row_indices[:k]
+        return distances, indices
 
     def recommend_songs(self, playlist, N):
-        # Transform input playlist features
-        input_features = self.data[self.data['track_id'].isin(playlist)][self.features]
+        return self.recommend_batch([playlist], N)[0]
+
+    def recommend_batch(self, playlists, N):
+        """
+        Recommend N songs for each playlist with a single kneighbors query.
+
+        The neighbors of every seed of every playlist are combined according to
+        self.aggregation in one vectorized pass.
+        """
+        return [tracks.tolist() for tracks, _ in self.recommend_scored_batch(playlists, N)]
+
+    def recommend_scored(self, playlist, N):
+        return self.recommend_scored_batch([playlist], N)[0]
+
+    def recommend_scored_batch(self, playlists, N):
+        """
+        Like recommend_batch, with the scores: a (tracks, scores) pair of arrays per playlist, best first.
 
-        if input_features.shape[0] == 0:
+        Scores are cosine similarities for first and centroid, fused
+        reciprocal ranks for rank_fusion and summed similarities for
+        distance_weighted.
+        """
+        timer = self.profiler.timer("item_based") if self.profiler is not None else None
+        empty = (self.track_ids[:0], np.empty(0))
+        recommended = [empty for _ in playlists]
+        rows, queries = self.seed_rows(playlists)
+        known = np.zeros(len(playlists), dtype=bool)
+        known[queries] = True
+        for _ in range(len(playlists) - known.sum()):
             print("Input features are empty. Cannot recommend songs.")
-            return []
+        if timer is not None:
+            timer.lap("seed_lookup", playlists=len(playlists), seeds=len(rows))
+        if len(rows) == 0 or N <= 0:
+            return recommended
 
-        # Query NearestNeighbors for similar items
-        _, indices = self.nearest_neighbors.kneighbors(input_features)
+        # One kneighbors call with the largest k, each list is then cut to its playlist's k
+        k = self.n_neighbors(playlists, N)
+        starts = np.flatnonzero(np.diff(queries, prepend=-1))
+        if self.aggregation == 'centroid':
+            query_rows = None
+            query_features = np.add.reduceat(normalize_rows(self.feature_matrix[rows]), starts)
+        else:
+            query_rows = np.minimum.reduceat(rows, starts) if self.aggregation == 'first' else rows
+            query_features = self.feature_matrix[query_rows]
+        list_queries = queries[starts] if self.aggregation in ('first', 'centroid') else queries
+        if self.seed_cache is not None and query_rows is not None:
+            distances, indices = self.cached_kneighbors(query_rows, k[list_queries])
+        else:
+            distances, indices = self.kneighbors(query_features, k[list_queries].max())
+        if timer is not None:
+            timer.lap("neighbor_search", neighbors=indices.size)
 
-        # Get recommended songs
-        recommended_songs = self.data.iloc[indices[0]]['track_id'].tolist()
+        ranks = np.broadcast_to(np.arange(1, indices.shape[1] + 1), indices.shape)
+        similarities = 1 - np.asarray(distances, dtype=np.float64)
+        if self.aggregation in ('first', 'centroid'):
+            # One list per playlist: keep its order
+            weights = -ranks
+        elif self.aggregation == 'rank_fusion':
+            weights = 1 / (self.rank_fusion_k + ranks)
+        else:
+            weights = similarities
+        in_list = ranks <= k[list_queries][:, None]
+        candidate_queries = np.broadcast_to(list_queries[:, None], indices.shape)[in_list]
 
-        recommended_songs = [song for song in recommended_songs if song not in playlist]
+        # Merge candidates per (playlist, track) and drop the seeds. A track can sit on several rows, each row
+        # only adds to a track's score once
+        n_rows = len(self.feature_matrix)
+        weights, similarities = weights[in_list], similarities[in_list]
+        candidate_keys = candidate_queries * n_rows + self.row_tracks[indices[in_list]]
+        if self.aggregation in ('first', 'centroid'):
+            # One list per playlist: a track keeps its best rank and similarity
+            order = np.lexsort((-weights, candidate_keys))
+            candidate_keys, weights, similarities = candidate_keys[order], weights[order], similarities[order]
+            starts = np.flatnonzero(np.diff(candidate_keys, prepend=-1))
+            keys = candidate_keys[starts]
+            scores = np.maximum.reduceat(weights, starts)
+            reported = np.maximum.reduceat(similarities, starts)
+        else:
+            # Each seed's list counts a track once, at its best rank, and ranks count distinct tracks
+            list_ids = np.broadcast_to(np.arange(len(indices))[:, None], indices.shape)[in_list]
+            first = np.sort(np.unique(list_ids * n_rows + self.row_tracks[indices[in_list]], return_index=True)[1])
+            list_ids, weights = list_ids[first], weights[first]
+            if self.aggregation == 'rank_fusion':
+                weights = 1 / (self.rank_fusion_k + 1 + np.arange(len(first)) - np.searchsorted(list_ids, list_ids))
+            keys, inverse = np.unique(candidate_keys[first], return_inverse=True)
+            scores = reported = np.bincount(inverse, weights=weights)
+        if timer is not None:
+            timer.lap("aggregation", candidates=len(keys))
+        keep = ~np.isin(keys, queries * n_rows + rows)
+        keys, scores, reported = keys[keep], scores[keep], reported[keep]
+        candidate_queries, candidate_rows = keys // n_rows, keys % n_rows
+        if timer is not None:
+            timer.lap("exclusion")
 
-        return recommended_songs[:N]
+        # Per playlist: highest score first, earlier row on ties
+        order = np.lexsort((candidate_rows, -scores, candidate_queries))
+        candidate_queries, candidate_rows, reported = candidate_queries[order], candidate_rows[order], reported[order]
+        ranks = np.arange(len(order)) - np.searchsorted(candidate_queries, candidate_queries)
+        top = ranks < N
+        if timer is not None:
+            timer.lap("sorting")
+        candidate_queries = candidate_queries[top]
+        bounds = np.searchsorted(candidate_queries, np.arange(1, len(playlists)))
+        recommended = list(zip(np.split(self.track_ids[candidate_rows[top]], bounds), np.split(reported[top], bounds)))
+        if timer is not None:
+            timer.finish("output", recommended=int(top.sum()))
+        return recommended
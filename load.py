@@ -1,8 +1,12 @@
+import contextlib
 import json
 import pandas as pd
 import os
 import shutil
 import math
+import multiprocessing
+
+from playlist_arrays import PlaylistArrays
 
 def load_json(file_path):
     """
@@ -19,6 +23,122 @@ def load_json(file_path):
     return data
 
 
+class JsonStream:
+    """
+    Incremental reader for a JSON file, decoding one value at a time.
+
+    Only the current read buffer and the value being decoded are held in memory.
+    """
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Drop the consumed part of the buffer and read the next chunk
+        chunk = self.f.read(self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return bool(chunk)
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON file")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in JSON file, got {self.buffer[self.pos]!r}")
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+class PlaylistWriter:
+    """
+    Incremental writer for an MPD-format JSON file, encoding one playlist at a time.
+
+    Playlists are written compactly as they come, so only the current one is held in memory.
+    """
+
+    def __init__(self, file_path, header=""):
+        # header holds top-level fields written before the playlists, e.g. '"info":true,'
+        self.f = open(file_path, 'w')
+        self.f.write('{' + header + '"playlists":[')
+        self.count = 0
+
+    def write(self, playlist):
+        if self.count:
+            self.f.write(",")
+        json.dump(playlist, self.f, separators=(",", ":"))
+        self.count += 1
+
+    def close(self):
+        self.f.write("]}")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_playlists(file_path):
+    """
+    Iterate over the playlists of an MPD-format JSON file without loading it whole.
+
+    Args:
+    - file_path (str): Path to the JSON file.
+
+    Yields:
+    - dict: One playlist at a time.
+    """
+    with open(file_path, 'r') as f:
+        stream = JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(":")
+            if key == "playlists":
+                stream.expect("[")
+                if stream.peek() != "]":
+                    while True:
+                        yield stream.decode()
+                        if stream.peek() == "]":
+                            break
+                        stream.expect(",")
+                stream.pos += 1
+            else:
+                # Small top-level fields such as info, date and version
+                stream.decode()
+            if stream.peek() == "}":
+                return
+            stream.expect(",")
+
 
 def load_90k_set(datapath):
     """
@@ -87,6 +207,49 @@ def filter_playlists_with_tracks(json_data, output_file, playlist_length_minimum
     print("Filtered data saved to:", output_file)
 
 
+def build_csv_index(csv_data):
+    """
+    Build a lookup from track ID to its index in the CSV data.
+
+    Built once and shared by every slice, replacing a scan of the CSV data
+    per matched track.
+
+    Args:
+    - csv_data (pandas.DataFrame): CSV data containing track information.
+
+    Returns:
+    - dict: Track ID -> index of its first row in the CSV data.
+    """
+    csv_index = {}
+    for index, track_id in zip(csv_data.index.tolist(), csv_data['track_id'].tolist()):
+        csv_index.setdefault(track_id, index)
+    return csv_index
+
+
+def match_tracks(tracks, csv_index):
+    """
+    Match the tracks of one playlist with those in the CSV data.
+
+    Args:
+    - tracks (list): Track dicts of the playlist.
+    - csv_index (dict): Track ID -> CSV index, from build_csv_index.
+
+    Returns:
+    - list: Matched tracks with pos, track_uri (track ID) and index_in_csv.
+    """
+    filtered_tracks = []
+    for track in tracks:
+        track_id = track["track_uri"].split(":")[-1]  # Extract track ID
+        csv_index_value = csv_index.get(track_id)
+        if csv_index_value is not None:
+            filtered_tracks.append({
+                "pos": track["pos"],
+                "track_uri": track_id,
+                "index_in_csv": int(csv_index_value),  # Convert int64 to Python int
+            })
+    return filtered_tracks
+
+
 def match_data(json_data, csv_data, output_file, limit_progress=True, info=None, playlist_length_minimum=1):
     """
     Match tracks from the JSON data with those in the CSV data.
@@ -104,10 +267,8 @@ def match_data(json_data, csv_data, output_file, limit_progress=True, info=None,
     """
     print("Matching data")
 
-    matched_data = []
-
-    # Create a set to store track IDs from the CSV data for faster lookup
-    csv_track_ids = set(csv_data['track_id'])
+    # Map track IDs to their CSV index once for fast lookup
+    csv_index = build_csv_index(csv_data)
 
     # Initialize variables to track progress and matches
     total_matches = 0
@@ -115,23 +276,9 @@ def match_data(json_data, csv_data, output_file, limit_progress=True, info=None,
     # Iterate over the playlists in the JSON data
     filtered_playlists = []
     for index, playlist in enumerate(json_data["playlists"]):
-        # Initialize filtered tracks for the current playlist
-        filtered_tracks = []
-
-        # Iterate over the tracks in the playlist
-        for track in playlist["tracks"]:
-            track_id = track["track_uri"].split(":")[-1]  # Extract track ID
-            if track_id in csv_track_ids:
-                # Track ID found in CSV data, add it to matched data
-                csv_index = csv_data[csv_data['track_id'] == track_id].index[0]  # Get index in CSV
-                matched_data.append({
-                    "pos": track["pos"],
-                    "track_uri": track_id,
-                    "index_in_csv": int(csv_index),  # Convert int64 to Python int
-                })
-                track["index_in_csv"] = int(csv_index)  # Add index to track metadata
-                filtered_tracks.append(track)
-                total_matches += 1
+        # Keep only the tracks found in the CSV data
+        filtered_tracks = match_tracks(playlist["tracks"], csv_index)
+        total_matches += len(filtered_tracks)
         
         # If there are tracks in the playlist after filtering
         if len(filtered_tracks) >= playlist_length_minimum:
@@ -171,6 +318,67 @@ def match_data(json_data, csv_data, output_file, limit_progress=True, info=None,
 
 
 
+def process_slice(json_file_path, csv_index, output_file, playlist_length_minimum=10, intersected=None,
+                  included_file=None, excluded_file=None, match_on="name"):
+    """
+    Filter, match and optionally separate one MPD slice in a single streaming pass.
+
+    Playlists are read one at a time, shorter ones are dropped, their tracks are
+    matched with the CSV data and the kept playlists are written compactly to
+    the output file, in the format match_data writes with info=True. With
+    intersected, each kept playlist is also written to included_file or
+    excluded_file, as separate_slice would split the output file.
+
+    Args:
+    - json_file_path (str): Path to the MPD slice.
+    - csv_index (dict): Track ID -> CSV index, from build_csv_index.
+    - output_file (str): Path to save the matched data.
+    - playlist_length_minimum (int): Minimum length of playlists to keep.
+    - intersected (set): Names or pids from intersected_keys, None to skip the split.
+    - included_file (str): Path for the kept playlists found in the intersected set.
+    - excluded_file (str): Path for the other kept playlists.
+    - match_on (str): "name" or "pid", as passed to intersected_keys.
+
+    Returns:
+    - tuple: (written, included) playlist counts of the output and included files, included is None without intersected.
+    """
+    total_matches = 0
+
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(PlaylistWriter(output_file, header='"info":true,'))
+        if intersected is not None:
+            included = stack.enter_context(PlaylistWriter(included_file))
+            excluded = stack.enter_context(PlaylistWriter(excluded_file))
+        for playlist in iter_playlists(json_file_path):
+            if len(playlist["tracks"]) < playlist_length_minimum:
+                continue
+
+            filtered_tracks = match_tracks(playlist["tracks"], csv_index)
+            total_matches += len(filtered_tracks)
+            if len(filtered_tracks) < playlist_length_minimum:
+                continue
+
+            filtered_playlist = {
+                "name": playlist.get("name", ""),
+                "pid": playlist["pid"],
+                "num_tracks": playlist["num_tracks"],
+                "tracks": filtered_tracks
+            }
+            output.write(filtered_playlist)
+            if intersected is not None:
+                key = filtered_playlist["name"] if match_on == "name" else filtered_playlist["pid"]
+                (included if key in intersected else excluded).write(filtered_playlist)
+
+    print("Total matches found:", total_matches)
+    print("Matched data saved to:", output_file)
+    if intersected is not None:
+        print("Included playlists saved to:", included_file)
+        print("Excluded playlists saved to:", excluded_file)
+        print("SPLIT incl, excl:", included.count, excluded.count)
+        return output.count, included.count
+    return output.count, None
+
+
 def count_playlists(json_data):
     """
     Count the number of playlists in the JSON data.
@@ -225,13 +433,91 @@ def get_index_in_csv_list(json_data):
 
     return index_in_csv_list
 
-def separate_playlists_by_name(json_final, jsons_folder):
+def intersected_keys(json_final, match_on="name"):
+    """
+    Collect the names (or pids) of the intersected playlists for fast membership tests.
+
+    Args:
+    - json_final (dict): Loaded JSON data containing playlists.
+    - match_on (str): "name" to match playlists by name, "pid" to match by pid.
+      Names collide heavily in the MPD, pids identify a single playlist. The
+      challenge set's pids (1,000,000 and up) are not MPD pids, so "pid" only
+      matches when json_final holds MPD playlists.
+
+    Returns:
+    - set: Names or pids of the playlists in json_final.
+    """
+    if match_on == "name":
+        return {item["name"] for item in json_final["playlists"]}
+    if match_on == "pid":
+        return {item["pid"] for item in json_final["playlists"]}
+    raise ValueError(f"Unknown match_on: {match_on}")
+
+
+def split_playlists(playlists, intersected, match_on="name"):
+    """
+    Split playlists by whether their name (or pid) is in the intersected set.
+
+    Args:
+    - playlists (iterable): Playlists to split.
+    - intersected (set): Names or pids from intersected_keys.
+    - match_on (str): "name" or "pid", as passed to intersected_keys.
+
+    Returns:
+    - tuple: (included_playlists, excluded_playlists) lists.
+    """
+    included_playlists = []
+    excluded_playlists = []
+    for playlist in playlists:
+        key = playlist.get("name", "") if match_on == "name" else playlist["pid"]
+        if key in intersected:
+            included_playlists.append(playlist)
+        else:
+            excluded_playlists.append(playlist)
+    return included_playlists, excluded_playlists
+
+
+def separate_slice(json_file_path, intersected, included_folder, excluded_folder, match_on="name"):
+    """
+    Separate the playlists of one adjusted slice by whether they are in the intersected set.
+
+    Args:
+    - json_file_path (str): Path to the adjusted slice JSON file.
+    - intersected (set): Names or pids from intersected_keys.
+    - included_folder (str): Folder for the playlists found in the intersected set.
+    - excluded_folder (str): Folder for the other playlists.
+    - match_on (str): "name" or "pid", as passed to intersected_keys.
+
+    Returns:
+    - None
+    """
+    print("Processing JSON file:", json_file_path)
+
+    # Extract base name of the JSON file without extension
+    base_name = os.path.splitext(os.path.basename(json_file_path))[0]
+
+    included_output_file = os.path.join(included_folder, f"{base_name}_included.json")
+    output_output_file = os.path.join(excluded_folder, f"{base_name}_excluded.json")
+    with PlaylistWriter(included_output_file) as included, PlaylistWriter(output_output_file) as excluded:
+        for playlist in iter_playlists(json_file_path):
+            key = playlist.get("name", "") if match_on == "name" else playlist["pid"]
+            (included if key in intersected else excluded).write(playlist)
+    print("Included playlists saved to:", included_output_file)
+    print("Excluded playlists saved to:", output_output_file)
+
+    print("SPLIT incl, excl:", included.count, excluded.count)
+
+    print()  # Add an empty line for better readability
+
+
+def separate_playlists_by_name(json_final, jsons_folder, match_on="name"):
     """
     Separate playlists by name based on whether they are present in json_final.
 
     Args:
     - json_final (dict): Loaded JSON data containing playlists.
     - jsons_folder (str): Path to the folder containing JSON files of complete dataset.
+    - match_on (str): "name" (default) or "pid" to match playlists by pid.
 
     Returns:
     - None
@@ -243,45 +529,57 @@ def separate_playlists_by_name(json_final, jsons_folder):
     os.makedirs(included_folder, exist_ok=True)
     os.makedirs(output_folder, exist_ok=True)
 
-    # Iterate over the JSON files in the folder
-    for filename in os.listdir(jsons_folder):
+    # Build the lookup once instead of scanning json_final per playlist
+    intersected = intersected_keys(json_final, match_on)
+
+    # Iterate over the JSON files in the folder, in a fixed order
+    for filename in sorted(os.listdir(jsons_folder)):
         if filename.endswith(".json"):
-            json_file_path = os.path.join(jsons_folder, filename)
-            print("Processing JSON file:", json_file_path)
+            separate_slice(os.path.join(jsons_folder, filename), intersected, included_folder, output_folder, match_on)
 
-            # Load the JSON data
-            json_data = load_json(json_file_path)
 
-            # Extract base name of the JSON file without extension
-            base_name = os.path.splitext(filename)[0]
+# Shared with the slice worker processes, set by init_slice_worker
+_csv_index = None
+_intersected = None
 
-            # Initialize lists to store included and excluded playlists
-            included_playlists = []
-            excluded_playlists = []
 
-            # Iterate over the playlists in the JSON data
-            for playlist in json_data["playlists"]:
-                playlist_name = playlist.get("name", "")
-                if any(item["name"] == playlist_name for item in json_final["playlists"]):
-                    included_playlists.append(playlist)
-                else:
-                    excluded_playlists.append(playlist)
+def init_slice_worker(csv_index, intersected):
+    """
+    Give a slice worker the CSV index and the intersected names (or pids).
 
-            # Save included playlists to the included folder
-            included_output_file = os.path.join(included_folder, f"{base_name}_included.json")
-            with open(included_output_file, 'w') as f:
-                json.dump({"playlists": included_playlists}, f, indent=4)
-            print("Included playlists saved to:", included_output_file)
+    Called once per worker process; with the fork start method the data is
+    shared copy-on-write instead of being copied.
+    """
+    global _csv_index, _intersected
+    _csv_index = csv_index
+    _intersected = intersected
 
-            # Save excluded playlists to the output folder
-            output_output_file = os.path.join(output_folder, f"{base_name}_excluded.json")
-            with open(output_output_file, 'w') as f:
-                json.dump({"playlists": excluded_playlists}, f, indent=4)
-            print("Excluded playlists saved to:", output_output_file)
 
-            print("SPLIT incl, excl:", len(included_playlists), len(excluded_playlists))
+def process_slice_file(json_file_path):
+    """
+    Ingest, filter, match and separate one MPD slice.
 
-            print()  # Add an empty line for better readability
+    Writes data/complete_adjusted/<slice>_adjusted.json and its included and
+    excluded splits. Uses the data set by init_slice_worker.
+
+    Args:
+    - json_file_path (str): Path to the MPD slice.
+
+    Returns:
+    - int: Number of playlists in the included playlists file.
+    """
+    print("\nLoading JSON file:", json_file_path)
+
+    # Extract base name of the JSON file without extension
+    base_name = os.path.splitext(os.path.basename(json_file_path))[0]
+
+    # Filter, match, save and split into playlists that are and are not in the intersected set, in one streaming pass
+    output_file = f"data/complete_adjusted/{base_name}_adjusted.json"
+    included_file = os.path.join("data/complete_adjusted/included", f"{base_name}_adjusted_included.json")
+    excluded_file = os.path.join("data/complete_adjusted/excluded", f"{base_name}_adjusted_excluded.json")
+    _, included = process_slice(json_file_path, _csv_index, output_file, playlist_length_minimum=10, intersected=_intersected,
+                                included_file=included_file, excluded_file=excluded_file, match_on=split_match_on)
+    return included
 
 
 def combine_included_playlists(included_folder, output_file):
@@ -302,8 +600,8 @@ def combine_included_playlists(included_folder, output_file):
     output_folder = os.path.dirname(output_file)
     os.makedirs(output_folder, exist_ok=True)
 
-    # Iterate over the JSON files in the included folder
-    for filename in os.listdir(included_folder):
+    # Iterate over the JSON files in the included folder, in a fixed order
+    for filename in sorted(os.listdir(included_folder)):
         if filename.endswith(".json"):
             json_file_path = os.path.join(included_folder, filename)
             print("Processing JSON file:", json_file_path)
@@ -324,7 +622,35 @@ def combine_included_playlists(included_folder, output_file):
 
     print("Combined playlists saved to:", output_file)
 
-def split_combined_playlists(input_file, output_folder, output_1, output_2,split=50):
+def arrays_folder(json_file):
+    """
+    Folder holding the binary PlaylistArrays copy of a playlist JSON file.
+
+    Args:
+    - json_file (str): Path to the JSON file, e.g. final_data/EvalSet.json.
+
+    Returns:
+    - str: Path to the folder, e.g. final_data/EvalSet_arrays.
+    """
+    return os.path.splitext(json_file)[0] + "_arrays"
+
+
+def save_playlist_arrays(playlists, output_folder):
+    """
+    Save playlists in the columnar binary format read by main.py and the filters.
+
+    Args:
+    - playlists (list): Playlist dicts.
+    - output_folder (str): Folder to write the .npy files to.
+
+    Returns:
+    - None
+    """
+    PlaylistArrays.from_playlists(playlists).save(output_folder)
+    print("Playlist arrays saved to:", output_folder)
+
+
+def split_combined_playlists(input_file, output_folder, output_1, output_2,split=50, write_arrays=False):
     """
     Split the combined JSON file into two parts with approximately equal playlists.
 
@@ -333,6 +659,7 @@ def split_combined_playlists(input_file, output_folder, output_1, output_2,split
     - output_folder (str): Path to the folder where the split JSON files will be saved.
     - output_1 (str): Filename for the first split JSON file.
     - output_2 (str): Filename for the second split JSON file.
+    - write_arrays (bool): Also save each part with save_playlist_arrays.
 
     Returns:
     - None
@@ -370,6 +697,10 @@ def split_combined_playlists(input_file, output_folder, output_1, output_2,split
     print("Split playlists saved to:", output_file2)
     print("Number of playlists in", output_2, ":", len(playlists_file2))
 
+    if write_arrays:
+        save_playlist_arrays(playlists_file1, arrays_folder(output_file1))
+        save_playlist_arrays(playlists_file2, arrays_folder(output_file2))
+
     # Check if the number of playlists in each split is too different
     playlist_diff = abs(len(playlists_file1) - len(playlists_file2))
     # if playlist_diff > 1:
@@ -377,6 +708,8 @@ def split_combined_playlists(input_file, output_folder, output_1, output_2,split
 
 createEvalSet = True
 dataslices_max = 100000000 # increase if you want more data <<< you need enough data slices from the initial set >>
+slice_workers = os.cpu_count() or 1 # processes used to load the slices, 1 loads them one by one
+split_match_on = "name" # "pid" puts a slice playlist in the test/eval sets only if its pid is in intersected.json, which needs an intersected.json of MPD playlists: challenge set pids are not in the slices
 
 def main():
     if not os.path.exists("data/intersected.json"):
@@ -409,63 +742,43 @@ def main():
         # Load the CSV data
         print("Loading CSV data")
         csv_data = load_90k_set("data/csv_filtered.csv")
+        csv_index = build_csv_index(csv_data)
 
         # Specify the folder containing JSON files
         jsons_folder = "data/completedataset"
 
-        slice = 0
-
         complete_adjusted_folder = "data/complete_adjusted"
         if os.path.exists(complete_adjusted_folder):
             shutil.rmtree(complete_adjusted_folder)
         os.makedirs(complete_adjusted_folder)
+        os.makedirs("data/complete_adjusted/included")
+        os.makedirs("data/complete_adjusted/excluded")
 
+        # Slices in a fixed order, so every run and worker count gives the same result
+        filenames = sorted(filename for filename in os.listdir(jsons_folder) if filename.endswith(".json"))
+        if len(filenames) > dataslices_max:
+            print("STOP loading, want more?: adjust the dataslices var")
+            filenames = filenames[:dataslices_max]
+        json_file_paths = [os.path.join(jsons_folder, filename) for filename in filenames]
 
-        # Iterate over the JSON files in the folder
-        for filename in os.listdir(jsons_folder):
-            if filename.endswith(".json"):
-                json_file_path = os.path.join(jsons_folder, filename)
-                print("\nLoading JSON file:", json_file_path)
-
-                # Load the JSON data
-                json_data = load_json(json_file_path)
-
-                # Extract base name of the JSON file without extension
-                base_name = os.path.splitext(filename)[0]
-
-  
-                # complete_adjusted_folder = "data/complete_adjusted"
-                # if not os.path.exists(complete_adjusted_folder):
-                #     os.makedirs(complete_adjusted_folder)
-
-
-                # Match the filtered JSON data with the CSV data and save to a file
-                output_file = f"data/complete_adjusted/{base_name}_adjusted.json"
-
-                # Filter playlists with zero tracks and save to a file
-                filter_playlists_with_tracks(json_data, output_file, playlist_length_minimum=10, info=True)
-                
-                # # Load the filtered JSON data
-                json_data_filtered = load_json(output_file)
-
-                # # Match the filtered JSON data with the CSV data and save to a file
-                match_data(json_data_filtered, csv_data, output_file, False, info=True, playlist_length_minimum=10)
-
-                json_data_filtered = load_json(output_file)
-
-                slice += 1
-
-                if slice == dataslices_max:
-                    print("STOP loading, want more?: adjust the dataslices var")
-                    break
-
-        print("split datasets into two")
         # load test json data
         print("load intersected test set")
         json_final = load_json("data/intersected.json")
-        json_filtered = "data/complete_adjusted"
-        # split into two sets   
-        separate_playlists_by_name(json_final, json_filtered)
+        intersected = intersected_keys(json_final, split_match_on)
+
+        # Filter, match and split every slice into included and excluded playlists
+        included_count = 0
+        if slice_workers > 1:
+            with multiprocessing.Pool(slice_workers, initializer=init_slice_worker,
+                                      initargs=(csv_index, intersected)) as pool:
+                for included in pool.imap(process_slice_file, json_file_paths):
+                    included_count += included
+        else:
+            init_slice_worker(csv_index, intersected)
+            for json_file_path in json_file_paths:
+                included_count += process_slice_file(json_file_path)
+        if included_count == 0:
+            raise ValueError(f"No slice playlist matched data/intersected.json on {split_match_on}, the test and eval sets would be empty")
 
         # combine the included datasets
         included_folder = "data/complete_adjusted/included"
@@ -474,7 +787,7 @@ def main():
 
         input_file = "data/complete_adjusted/included/included_combined.json"
         output_folder = "final_data"
-        split_combined_playlists(input_file, output_folder, "TestSet.json", "EvalSet.json", 30)
+        split_combined_playlists(input_file, output_folder, "TestSet.json", "EvalSet.json", 30, write_arrays=True)
 
         shutil.copy("data/csv_filtered.csv", "final_data/csv_filtered.csv")
 
@@ -1,15 +1,56 @@
 import json
+import os
 import time
 
-from user_based_filter import UserBasedFilter
+from sparse_user_based_filter import SparseUserBasedFilter
 from item_based_filter import ItemBasedFilter
+from ann_index import IVFIndex
+from matrix_factorization_filter import MatrixFactorizationFilter
+from hybrid_filter import HybridFilter
+from feature_pipeline import FeaturePipeline, file_hash
+from model_store import read_meta
+from playlist_arrays import PlaylistArrays
+from recommendation_cache import RecommendationCache
+from instrumentation import Profiler
+import numpy as np
 import pandas as pd
 from evaluation_metrics import EvaluationMetrics
 import concurrent.futures
+import multiprocessing
+
+# Metrics are reported at each cutoff K, all read off one ranked list of max(cutoffs) songs
+cutoffs = [5, 10, 20, 40, 500]
+metric_columns = {"precision": "Precision", "recall": "Recall", "f1_score": "F1 Score",
+                  "average_precision": "MAP", "reciprocal_rank": "MRR", "ndcg": "NDCG"}
+# Recommendation lists are kept on disk between runs, keyed on the model fingerprint, least recently used evicted first
+recommendation_cache_file = "cache/recommendations.sqlite"
+recommendation_cache_entries = 1000000
+result_cache = None
+# Per-seed partial results kept in memory by each filter, shared by playlists with common seeds; 0 disables them
+seed_cache_entries = 100000
+# Memory budget of each seed cache, in bytes of the arrays it holds
+seed_cache_bytes = 1 << 30
+# Implicit ALS recommender scored next to the other two; None leaves it out
+factorization_params = {"factors": 64, "regularization": 0.1, "alpha": 40.0, "iterations": 15, "threads": None}
+# Fusion of the user- and item-based candidates, each source asked for at most its budget; None leaves it out
+hybrid_params = {"aggregation": "rank_fusion", "weights": {"User-based": 1.0, "Item-based": 0.1},
+                 "budgets": {"User-based": 1000, "Item-based": 200}}
+# Label -> filter scored next to the user- and item-based filters, see build_extra_filters
+extra_filters = {}
+# Songs read from the song CSV
+song_rows = 50000
+# IVFIndex parameters for an approximate item-based neighbor search, None for the exact NearestNeighbors
+item_index_params = None
+# Opt-in per-stage timings, counts and (with profile_memory, slower) memory of evaluation and the filters,
+# written to profile_file + ".json" and ".prom"; covers this process only, so use n_workers = 1
+profiling = False
+profile_memory = False
+profile_file = "out/profile"
+profiler = None
 
 
 def load_csv_file(file_path):
-    return pd.read_csv(file_path, nrows=50000)
+    return pd.read_csv(file_path, nrows=song_rows)
 
 
 def load_json_file(file_path):
@@ -18,45 +59,80 @@ def load_json_file(file_path):
     return data
 
 
-def evaluate_playlist(playlist_data, N, user_based_filter, item_based_filter):
+def load_playlist_file(file_path):
+    # Memory-map the binary copy written by load.py when there is one
+    arrays_path = os.path.splitext(file_path)[0] + "_arrays"
+    if os.path.isdir(arrays_path):
+        return PlaylistArrays.load(arrays_path)
+    return load_json_file(file_path)
+
+
+def load_or_build(model_class, folder, fingerprint, build):
+    # Memory-map the saved model when it was built from the same data, otherwise build and save it
+    meta = read_meta(folder)
+    if meta is not None and meta.get("fingerprint") == fingerprint:
+        return model_class.load(folder)
+    model = build()
+    model.fingerprint = fingerprint
+    model.save(folder)
+    return model
+
+
+def split_playlist(playlist_data, N):
     # Extract tracks from the playlist data
     playlist_tracks = [track["track_uri"] for track in playlist_data["tracks"]]
 
     # Subtract the first N tracks from the playlist
-    input_playlist = playlist_tracks[:N]
-    playlist_tracks = playlist_tracks[N:]
+    return playlist_tracks[:N], playlist_tracks[N:]
+
+
+def evaluate_playlist(playlist_data, N, user_based_filter, item_based_filter, extra_filters=None):
+    timer = profiler.timer("evaluate_playlist") if profiler is not None else None
+    input_playlist, playlist_tracks = split_playlist(playlist_data, N)
+    if timer is not None:
+        timer.lap("split")
 
     # Make recommendations using user-based and item-based filters
-    user_recommendations = user_based_filter.recommend_songs(input_playlist, 40)
-    item_recommendations = item_based_filter.recommend_songs(input_playlist, 40)
-
-    # Evaluate user-based recommendations
-    user_based_precision = EvaluationMetrics.precision(playlist_tracks, user_recommendations)
-    user_based_recall = EvaluationMetrics.recall(playlist_tracks, user_recommendations)
-    user_based_f1_score = EvaluationMetrics.f1_score(playlist_tracks, user_recommendations)
-    user_based_map = EvaluationMetrics.average_precision(playlist_tracks, user_recommendations)
-    user_based_mrr = EvaluationMetrics.mean_reciprocal_rank([playlist_tracks], [user_recommendations])
-
-    # Evaluate item-based recommendations
-    item_based_precision = EvaluationMetrics.precision(playlist_tracks, item_recommendations)
-    item_based_recall = EvaluationMetrics.recall(playlist_tracks, item_recommendations)
-    item_based_f1_score = EvaluationMetrics.f1_score(playlist_tracks, item_recommendations)
-    item_based_map = EvaluationMetrics.average_precision(playlist_tracks, item_recommendations)
-    item_based_mrr = EvaluationMetrics.mean_reciprocal_rank(playlist_tracks, item_recommendations)
-
-    return {
-        "Playlist Name": playlist_data["name"],
-        "User-based Precision": user_based_precision,
-        "User-based Recall": user_based_recall,
-        "User-based F1 Score": user_based_f1_score,
-        "User-based MAP": user_based_map,
-        "User-based MRR": user_based_mrr,
-        "Item-based Precision": item_based_precision,
-        "Item-based Recall": item_based_recall,
-        "Item-based F1 Score": item_based_f1_score,
-        "Item-based MAP": item_based_map,
-        "Item-based MRR": item_based_mrr
-    }
+    user_recommendations = user_based_filter.recommend_songs(input_playlist, max(cutoffs))
+    if timer is not None:
+        timer.lap("user_based")
+    item_recommendations = item_based_filter.recommend_songs(input_playlist, max(cutoffs))
+    if timer is not None:
+        timer.lap("item_based")
+
+    recommendations = {"User-based": [user_recommendations], "Item-based": [item_recommendations]}
+    if extra_filters:
+        for label, recommender in extra_filters.items():
+            recommendations[label] = [recommender.recommend_songs(input_playlist, max(cutoffs))]
+        if timer is not None:
+            timer.lap("extra_filters")
+    data_row = score_recommendations([playlist_data], [playlist_tracks], recommendations)[0]
+    if timer is not None:
+        timer.finish("scoring")
+    return data_row
+
+
+def score_recommendations(test_playlists, held_out_tracks, recommendations, cutoffs=cutoffs):
+    """
+    Score one ranked list per playlist and filter at every cutoff.
+
+    recommendations maps a filter label, e.g. "User-based", to its ranked
+    lists. Metrics at K are computed on the first K items of each list, so
+    every cutoff reuses the same hit matrix.
+    """
+    data_rows = [{"Playlist Name": playlist_data["name"]} for playlist_data in test_playlists]
+    actual_counts = np.asarray([len(tracks) for tracks in held_out_tracks])
+
+    for label, recommended in recommendations.items():
+        actual_ids, recommended_ids = EvaluationMetrics.encode_lists(held_out_tracks, recommended)
+        hits = EvaluationMetrics.hit_matrix(actual_ids, recommended_ids)
+        recommended_counts = np.asarray([len(recs) for recs in recommended])
+        for K in cutoffs:
+            metrics = EvaluationMetrics.batch_metrics(hits[:, :K], actual_counts, np.minimum(recommended_counts, K), K)
+            for metric, column in metric_columns.items():
+                for row, value in zip(data_rows, metrics[metric].tolist()):
+                    row[f"{label} {column}@{K}"] = value
+    return data_rows
 
 
 def run_test_threaded(test_count=100, playlist_sample_size=5):
@@ -64,7 +140,8 @@ def run_test_threaded(test_count=100, playlist_sample_size=5):
     start_time = time.time()
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(evaluate_playlist, playlist_data, playlist_sample_size, user_based_filter, item_based_filter)
+        futures = [executor.submit(evaluate_playlist, playlist_data, playlist_sample_size, user_based_filter, item_based_filter,
+                                   extra_filters)
                    for playlist_data in testing_playlist_data["playlists"][:test_count]]
 
         for future in concurrent.futures.as_completed(futures):
@@ -82,7 +159,7 @@ def run_test(test_count=100, playlist_sample_size=5):
     start_time = time.time()
 
     for playlist_data in testing_playlist_data["playlists"][:test_count]:
-        result = evaluate_playlist(playlist_data, playlist_sample_size, user_based_filter, item_based_filter)
+        result = evaluate_playlist(playlist_data, playlist_sample_size, user_based_filter, item_based_filter, extra_filters)
         data_rows.append(result)
 
     elapsed_time = time.time() - start_time
@@ -92,6 +169,123 @@ def run_test(test_count=100, playlist_sample_size=5):
     return scores_df
 
 
+def recommend_cached(recommender, input_playlists, N, cache, result_cache=None):
+    # Seed lists repeat, e.g. a playlist shorter than the seed size gives the same
+    # seeds at every larger size; recommend each distinct one once
+    missing = [list(seeds) for seeds in dict.fromkeys(map(tuple, input_playlists)) if seeds not in cache]
+    if missing:
+        if result_cache is not None:
+            recommendations = result_cache.recommend_batch(recommender, missing, N)
+        else:
+            recommendations = recommender.recommend_batch(missing, N)
+        for seeds, recs in zip(missing, recommendations):
+            cache[tuple(seeds)] = recs
+    return [cache[tuple(input_playlist)] for input_playlist in input_playlists]
+
+
+def evaluate_playlists(test_playlists, playlist_sample_sizes, user_based_filter, item_based_filter, cutoffs=cutoffs,
+                       result_cache=None, extra_filters=None):
+    """
+    Score playlists at every seed size and cutoff.
+
+    Each filter ranks max(cutoffs) songs once per distinct seed list, in one
+    batched call per seed size; every cutoff is read off that ranked list.
+    With a result_cache, lists computed by an earlier run are read from disk.
+    extra_filters maps labels to further filters to score, e.g. "Factorization".
+
+    Returns a dict of seed size -> list of score rows.
+    """
+    filters = {"User-based": user_based_filter, "Item-based": item_based_filter}
+    filters.update(extra_filters or {})
+    caches = {label: {} for label in filters}
+
+    scores = {}
+    for playlist_sample_size in playlist_sample_sizes:
+        timer = profiler.timer("evaluate_playlists") if profiler is not None else None
+        splits = [split_playlist(playlist_data, playlist_sample_size) for playlist_data in test_playlists]
+        input_playlists = [input_playlist for input_playlist, _ in splits]
+        recommendations = {label: recommend_cached(recommender, input_playlists, max(cutoffs), caches[label], result_cache)
+                           for label, recommender in filters.items()}
+        if timer is not None:
+            timer.lap("recommend", playlists=len(test_playlists))
+        scores[playlist_sample_size] = score_recommendations(test_playlists, [playlist_tracks for _, playlist_tracks in splits],
+                                                             recommendations, cutoffs)
+        if timer is not None:
+            timer.finish("scoring")
+    return scores
+
+
+def run_test_batched(test_count=100, playlist_sample_sizes=(5,)):
+    start_time = time.time()
+
+    scores = evaluate_playlists(testing_playlist_data["playlists"][:test_count], playlist_sample_sizes,
+                                user_based_filter, item_based_filter, result_cache=result_cache,
+                                extra_filters=extra_filters)
+
+    elapsed_time = time.time() - start_time
+    print(f"Batched execution time: {elapsed_time:.4f} seconds")
+
+    return {playlist_sample_size: pd.DataFrame(data_rows) for playlist_sample_size, data_rows in scores.items()}
+
+
+def build_extra_filters(user_based_filter, item_based_filter, factorization_filter=None):
+    filters = {}
+    if factorization_filter is not None:
+        filters["Factorization"] = factorization_filter
+    if hybrid_params is not None:
+        filters["Hybrid"] = HybridFilter({"User-based": user_based_filter, "Item-based": item_based_filter}, **hybrid_params)
+    return filters
+
+
+def init_evaluation_worker(model_folders, cache=None):
+    # With fork the workers inherit the filters copy-on-write; otherwise, or when
+    # asked to, they memory-map the saved models instead of rebuilding them
+    global user_based_filter, item_based_filter, extra_filters, result_cache
+    result_cache = cache
+    if model_folders is not None or "user_based_filter" not in globals():
+        user_model_folder, item_model_folder = model_folders[:2] if model_folders else ("models/user_based", "models/item_based")
+        user_based_filter = SparseUserBasedFilter.load(user_model_folder)
+        item_based_filter = ItemBasedFilter.load(item_model_folder)
+        factorization_model_folder = model_folders[2] if model_folders and len(model_folders) > 2 else "models/factorization"
+        factorization_filter = None
+        if factorization_params is not None and read_meta(factorization_model_folder) is not None:
+            factorization_filter = MatrixFactorizationFilter.load(factorization_model_folder)
+        extra_filters = build_extra_filters(user_based_filter, item_based_filter, factorization_filter)
+
+
+def evaluate_chunk(args):
+    test_playlists, playlist_sample_sizes = args
+    return evaluate_playlists(test_playlists, playlist_sample_sizes, user_based_filter, item_based_filter,
+                              result_cache=result_cache, extra_filters=extra_filters)
+
+
+def run_test_processes(test_count=100, playlist_sample_sizes=(5,), workers=None, chunk_size=50, model_folders=None):
+    """
+    Evaluate playlists in a process pool, one batched chunk of playlists per task.
+
+    Returns a DataFrame per seed size, rows in playlist order as with run_test_batched.
+    model_folders is an optional (user, item) pair, or (user, item, factorization)
+    triple, of saved model folders for the workers to load; by default they
+    share this process's filters.
+    """
+    data_rows = {playlist_sample_size: [] for playlist_sample_size in playlist_sample_sizes}
+    start_time = time.time()
+
+    test_playlists = testing_playlist_data["playlists"][:test_count]
+    chunks = [(test_playlists[i:i + chunk_size], playlist_sample_sizes) for i in range(0, len(test_playlists), chunk_size)]
+
+    with multiprocessing.Pool(workers, initializer=init_evaluation_worker, initargs=(model_folders, result_cache)) as pool:
+        # imap keeps the chunk order, unlike as_completed
+        for chunk_scores in pool.imap(evaluate_chunk, chunks):
+            for playlist_sample_size, chunk_rows in chunk_scores.items():
+                data_rows[playlist_sample_size].extend(chunk_rows)
+
+    elapsed_time = time.time() - start_time
+    print(f"Multiprocess execution time: {elapsed_time:.4f} seconds")
+
+    return {playlist_sample_size: pd.DataFrame(rows) for playlist_sample_size, rows in data_rows.items()}
+
+
 def dataframe_mean(dataframe):
     average_scores = dataframe.drop(columns=["Playlist Name"]).mean()
     return average_scores
@@ -102,10 +296,17 @@ def main():
     n_tests = 10
     # set the list of samples
     n_samples_list = [2, 4, 6, 8]
+    # set the number of evaluation processes and playlists per task, 1 evaluates in this process
+    n_workers = 1
+    chunk_size = 50
 
-    for n_samples in n_samples_list:
-        scores_df = run_test(n_tests, n_samples)
+    # Every seed size is scored in one run, so recommendations are shared between them
+    if n_workers > 1:
+        scores = run_test_processes(n_tests, n_samples_list, n_workers, chunk_size)
+    else:
+        scores = run_test_batched(n_tests, n_samples_list)
 
+    for n_samples, scores_df in scores.items():
         average_scores = dataframe_mean(scores_df)
         print(average_scores)
 
@@ -124,10 +325,42 @@ if __name__ == '__main__':
     song_file_path = "final_data/csv_filtered.csv"
     testing_playlist_file_path = "final_data/TestSet.json"
 
-    playlist_data = load_json_file(playlist_file_path)
-    song_data = load_csv_file(song_file_path)
-    testing_playlist_data = load_json_file(testing_playlist_file_path)
-
-    user_based_filter = UserBasedFilter(playlist_data)
-    item_based_filter = ItemBasedFilter(song_data)
+    if profiling:
+        # Set on the classes before building, so fitting is profiled too
+        profiler = Profiler(profile_memory)
+        SparseUserBasedFilter.profiler = ItemBasedFilter.profiler = MatrixFactorizationFilter.profiler = profiler
+    playlist_data = load_playlist_file(playlist_file_path)
+    testing_playlist_data = load_playlist_file(testing_playlist_file_path)
+    if isinstance(testing_playlist_data, PlaylistArrays):
+        testing_playlist_data = testing_playlist_data.to_data()
+
+    # Fitted filters are saved to models/ and shared read-only by every process that loads them
+    user_based_filter = load_or_build(SparseUserBasedFilter, "models/user_based", file_hash(playlist_file_path),
+                                      lambda: SparseUserBasedFilter(playlist_data))
+    # Standardized features, cached in cache/ keyed on the CSV content
+    item_pipeline = FeaturePipeline()
+    item_config = {"pipeline": item_pipeline.config(), "nrows": song_rows, "index": item_index_params}
+    item_fingerprint = file_hash(song_file_path) + json.dumps(item_config, sort_keys=True)
+    item_index = IVFIndex(**item_index_params) if item_index_params is not None else None
+    item_based_filter = load_or_build(ItemBasedFilter, "models/item_based", item_fingerprint,
+                                      lambda: ItemBasedFilter.from_csv(song_file_path, item_pipeline, nrows=song_rows,
+                                                                       nearest_neighbors=item_index))
+    factorization_filter = None
+    if factorization_params is not None:
+        factorization_fingerprint = file_hash(playlist_file_path) + json.dumps(factorization_params, sort_keys=True)
+        factorization_filter = load_or_build(MatrixFactorizationFilter, "models/factorization", factorization_fingerprint,
+                                             lambda: MatrixFactorizationFilter(playlist_data, **factorization_params))
+    extra_filters = build_extra_filters(user_based_filter, item_based_filter, factorization_filter)
+    if recommendation_cache_file is not None:
+        result_cache = RecommendationCache(recommendation_cache_file, recommendation_cache_entries)
+    if seed_cache_entries:
+        user_based_filter.enable_seed_cache(seed_cache_entries, seed_cache_bytes)
+        item_based_filter.enable_seed_cache(seed_cache_entries, seed_cache_bytes)
     main()
+    if seed_cache_entries:
+        print("User-based seed cache:", user_based_filter.seed_cache.stats())
+        print("Item-based seed cache:", item_based_filter.seed_cache.stats())
+    if profiler is not None:
+        print(profiler.summary())
+        profiler.save_json(profile_file + ".json")
+        profiler.save_prometheus(profile_file + ".prom")
@@ -0,0 +1,240 @@
+import concurrent.futures
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from model_store import load_model, save_model
+from playlist_arrays import PlaylistArrays, lookup_vocabulary_ids, sort_vocabulary
+from sparse_user_based_filter import count_matrices
+
+
+class MatrixFactorizationFilter:
+    """
+    Implicit-feedback ALS (Hu, Koren and Volinsky) on the playlist x track matrix.
+
+    A track occurring r times in a playlist is a positive with confidence
+    1 + alpha * r, every other track a negative with confidence 1. Each ALS
+    half-step updates all playlist (or track) factors with cg_steps conjugate
+    gradient steps, warm-started from the previous factors, in blocks of
+    block_rows rows spread over threads worker threads.
+
+    Only the track factors are kept after fitting: a query folds its seeds
+    into a new playlist vector with one small solve, then scores every track
+    with a dot product, score_block_size tracks at a time.
+    """
+
+    # Optional instrumentation.Profiler for recommend_batch
+    profiler = None
+    score_block_size = 16384
+    fold_in_block_size = 1024
+
+    def __init__(self, data, factors=64, regularization=0.1, alpha=40.0, iterations=15, cg_steps=3, threads=None,
+                 block_rows=4096, random_state=0):
+        self.factors = factors
+        self.regularization = regularization
+        self.alpha = alpha
+        self.iterations = iterations
+        self.cg_steps = cg_steps
+        self.threads = threads
+        self.block_rows = block_rows
+        self.random_state = random_state
+        arrays = data if isinstance(data, PlaylistArrays) else PlaylistArrays.from_playlists(data["playlists"])
+        self.vocabulary = arrays.vocabulary
+        self.vocabulary_order, self.sorted_vocabulary = sort_vocabulary(self.vocabulary)
+        self.matrix, _ = count_matrices(arrays.tracks, arrays.offsets, len(self.vocabulary))
+        self.fit()
+
+    def params(self):
+        return {"factors": self.factors, "regularization": self.regularization, "alpha": self.alpha,
+                "iterations": self.iterations, "cg_steps": self.cg_steps, "random_state": self.random_state}
+
+    def fit(self):
+        """
+        Train the playlist and track factors on self.matrix.
+        """
+        rng = np.random.default_rng(self.random_state)
+        n_playlists, n_tracks = self.matrix.shape
+        matrix_t = self.matrix.T.tocsr()
+        self.playlist_factors = np.zeros((n_playlists, self.factors), dtype=np.float32)
+        self.track_factors = (rng.standard_normal((n_tracks, self.factors)) * 0.01).astype(np.float32)
+        with concurrent.futures.ThreadPoolExecutor(self.threads or os.cpu_count()) as executor:
+            for _ in range(self.iterations):
+                self.least_squares(self.matrix, self.track_factors, self.playlist_factors, executor)
+                self.least_squares(matrix_t, self.playlist_factors, self.track_factors, executor)
+        self.gram = self.track_factors.T @ self.track_factors
+
+    def least_squares(self, matrix, fixed, solved, executor):
+        # Rows of solved are independent given fixed, so blocks of rows run in parallel
+        gram = fixed.T @ fixed + self.regularization * np.eye(self.factors, dtype=np.float32)
+        starts = range(0, matrix.shape[0], self.block_rows)
+        for _ in executor.map(lambda start: self.conjugate_gradient(matrix, fixed, solved, gram, start), starts):
+            pass
+
+    def conjugate_gradient(self, matrix, fixed, solved, gram, start):
+        """
+        Improve solved[start:start + block_rows] in place with cg_steps steps of conjugate gradient.
+
+        Row u solves (F^T C_u F + regularization I) x_u = F^T C_u p_u with F
+        the fixed factors; F^T C_u F is F^T F plus a correction from the
+        row's nonzeros only, so it is never formed.
+        """
+        block = matrix[start:start + self.block_rows]
+        indices, indptr = block.indices, block.indptr
+        weights = self.alpha * block.data.astype(np.float32)
+        rows = np.repeat(np.arange(block.shape[0]), np.diff(indptr))
+        fixed_rows = fixed[indices]
+
+        def product(x):
+            corrections = np.einsum("kf,kf->k", fixed_rows, x[rows]) * weights
+            return x @ gram + csr_matrix((corrections, indices, indptr), shape=block.shape) @ fixed
+
+        x = solved[start:start + self.block_rows]
+        residual = csr_matrix((1 + weights, indices, indptr), shape=block.shape) @ fixed - product(x)
+        direction = residual.copy()
+        residual_norms = np.einsum("uf,uf->u", residual, residual)
+        for _ in range(self.cg_steps):
+            directed = product(direction)
+            curvature = np.einsum("uf,uf->u", direction, directed)
+            step = np.divide(residual_norms, curvature, out=np.zeros_like(residual_norms), where=curvature > 0)
+            x = x + step[:, None] * direction
+            residual = residual - step[:, None] * directed
+            new_norms = np.einsum("uf,uf->u", residual, residual)
+            ratio = np.divide(new_norms, residual_norms, out=np.zeros_like(new_norms), where=residual_norms > 0)
+            direction = residual + ratio[:, None] * direction
+            residual_norms = new_norms
+        solved[start:start + self.block_rows] = x
+
+    def save(self, folder):
+        """
+        Save the track factors so other processes can memory-map them with load().
+        """
+        arrays = {"vocabulary": self.vocabulary, "vocabulary_order": self.vocabulary_order,
+                  "sorted_vocabulary": self.sorted_vocabulary, "track_factors": self.track_factors, "gram": self.gram}
+        save_model(folder, arrays, dict(self.params(), model=type(self).__name__, fingerprint=getattr(self, "fingerprint", None)))
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Load a filter saved with save(). Only queries are possible, the training matrix and playlist factors are not saved.
+        """
+        arrays, meta = load_model(folder, mmap)
+        factorization_filter = cls.__new__(cls)
+        for name in ("factors", "regularization", "alpha", "iterations", "cg_steps", "random_state"):
+            setattr(factorization_filter, name, meta[name])
+        factorization_filter.threads = None
+        factorization_filter.block_rows = 4096
+        factorization_filter.vocabulary = arrays["vocabulary"]
+        factorization_filter.vocabulary_order = arrays["vocabulary_order"]
+        factorization_filter.sorted_vocabulary = arrays["sorted_vocabulary"]
+        factorization_filter.track_factors = arrays["track_factors"]
+        factorization_filter.gram = arrays["gram"]
+        factorization_filter.matrix = None
+        factorization_filter.fingerprint = meta["fingerprint"]
+        return factorization_filter
+
+    def lookup_ids(self, uris):
+        # Id of every uri, -1 for uris not in the vocabulary
+        return lookup_vocabulary_ids(self.vocabulary_order, self.sorted_vocabulary, uris)
+
+    def fold_in(self, seed_ids, seed_queries, n_queries):
+        """
+        Playlist factors of the queries, solved against the fixed track factors.
+
+        A query's seeds play the role of its nonzeros, counted as often as
+        they occur, so a query equal to a training playlist gets (up to the
+        conjugate gradient error) that playlist's factors.
+        """
+        n_tracks = len(self.track_factors)
+        keys, counts = np.unique(seed_queries * n_tracks + seed_ids, return_counts=True)
+        queries, tracks = keys // n_tracks, keys % n_tracks
+        weights = self.alpha * counts
+        base = self.gram + self.regularization * np.eye(self.factors)
+
+        # One factors x factors system per query, solved fold_in_block_size queries at a time to bound memory
+        playlist_factors = np.empty((n_queries, self.factors), dtype=np.float32)
+        bounds = np.searchsorted(queries, np.arange(0, n_queries + self.fold_in_block_size, self.fold_in_block_size))
+        for block, start in enumerate(range(0, n_queries, self.fold_in_block_size)):
+            block_queries = min(self.fold_in_block_size, n_queries - start)
+            part = slice(bounds[block], bounds[block + 1])
+            block_rows = queries[part] - start
+            seed_factors = np.asarray(self.track_factors[tracks[part]], dtype=np.float64)
+            systems = np.broadcast_to(base, (block_queries, self.factors, self.factors)).copy()
+            np.add.at(systems, block_rows, weights[part, None, None] * seed_factors[:, :, None] * seed_factors[:, None, :])
+            targets = np.zeros((block_queries, self.factors))
+            np.add.at(targets, block_rows, (1 + weights[part])[:, None] * seed_factors)
+            playlist_factors[start:start + block_queries] = np.linalg.solve(systems, targets[:, :, None])[:, :, 0]
+        return playlist_factors
+
+    def recommend_songs(self, playlist, N):
+        return self.recommend_batch([playlist], N)[0]
+
+    def recommend_batch(self, playlists, N):
+        """
+        Recommend the N tracks with the highest dot product with each playlist's folded-in factors.
+
+        Seeds are never recommended; ties go to the lower track id.
+        """
+        return [tracks.tolist() for tracks, _ in self.recommend_scored_batch(playlists, N)]
+
+    def recommend_scored(self, playlist, N):
+        return self.recommend_scored_batch([playlist], N)[0]
+
+    def recommend_scored_batch(self, playlists, N):
+        """
+        Like recommend_batch, with the dot products as scores: a (tracks, scores) pair of arrays per playlist.
+        """
+        timer = self.profiler.timer("matrix_factorization") if self.profiler is not None else None
+        empty = (self.vocabulary[:0], np.empty(0))
+        recommended = [empty for _ in playlists]
+        seed_lists = [self.lookup_ids(playlist) for playlist in playlists]
+        seed_ids = np.concatenate(seed_lists) if seed_lists else np.empty(0, dtype=np.int64)
+        seed_queries = np.repeat(np.arange(len(playlists)), [len(seeds) for seeds in seed_lists])
+        seed_queries, seed_ids = seed_queries[seed_ids >= 0], seed_ids[seed_ids >= 0]
+        if timer is not None:
+            timer.lap("seed_lookup", playlists=len(playlists), seeds=len(seed_ids))
+        if len(seed_ids) == 0 or N <= 0:
+            return recommended
+
+        # Queries without known seeds get no recommendations, like in the other filters
+        known_queries, seed_queries = np.unique(seed_queries, return_inverse=True)
+        playlist_factors = self.fold_in(seed_ids, seed_queries, len(known_queries))
+        if timer is not None:
+            timer.lap("fold_in")
+
+        # Best N of each block of tracks, then the best N of those
+        candidate_tracks, candidate_scores = [], []
+        for start in range(0, len(self.track_factors), self.score_block_size):
+            scores = playlist_factors @ np.asarray(self.track_factors[start:start + self.score_block_size]).T
+            in_block = (seed_ids >= start) & (seed_ids < start + scores.shape[1])
+            scores[seed_queries[in_block], seed_ids[in_block] - start] = -np.inf
+            # Every track scoring at least the k-th best, so a tie at the cut goes to the lower id
+            k = min(N, scores.shape[1])
+            kth = np.partition(scores, scores.shape[1] - k, axis=1)[:, scores.shape[1] - k]
+            rows, columns = np.nonzero(scores >= kth[:, None])
+            values = scores[rows, columns]
+            order = np.lexsort((columns, -values, rows))
+            rows, columns, values = rows[order], columns[order], values[order]
+            top = np.arange(len(rows)) - np.searchsorted(rows, rows) < k
+            candidate_tracks.append(columns[top].reshape(-1, k) + start)
+            candidate_scores.append(values[top].reshape(-1, k))
+        candidate_tracks = np.concatenate(candidate_tracks, axis=1)
+        candidate_scores = np.concatenate(candidate_scores, axis=1)
+        if timer is not None:
+            timer.lap("scoring", candidates=candidate_tracks.size)
+
+        by_track = np.argsort(candidate_tracks, axis=1)
+        candidate_tracks = np.take_along_axis(candidate_tracks, by_track, axis=1)
+        candidate_scores = np.take_along_axis(candidate_scores, by_track, axis=1)
+        order = np.argsort(-candidate_scores, axis=1, kind="stable")[:, :N]
+        top_tracks = np.take_along_axis(candidate_tracks, order, axis=1)
+        top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        if timer is not None:
+            timer.lap("sorting")
+
+        for query, tracks, scores in zip(known_queries.tolist(), top_tracks, top_scores):
+            finite = np.isfinite(scores)
+            recommended[query] = (self.vocabulary[tracks[finite]], scores[finite].astype(np.float64))
+        if timer is not None:
+            timer.finish("output", recommended=int(np.isfinite(top_scores).sum()))
+        return recommended
@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def save_model(folder, arrays, meta):
+    """
+    Save a fitted model as one .npy file per array plus a meta.json.
+
+    The folder is written next to the target and swapped in at the end, so a
+    process reading the old model never sees a half-written one.
+
+    Args:
+    - folder (str): Folder to save the model to; replaced if it exists.
+    - arrays (dict): Name -> numpy array.
+    - meta (dict): JSON-serializable settings needed to rebuild the model.
+
+    Returns:
+    - None
+    """
+    temporary_folder = folder + ".tmp"
+    if os.path.exists(temporary_folder):
+        shutil.rmtree(temporary_folder)
+    os.makedirs(temporary_folder)
+
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary_folder, f"{name}.npy"), np.asarray(array))
+    with open(os.path.join(temporary_folder, "meta.json"), 'w') as f:
+        json.dump(dict(meta, arrays=sorted(arrays)), f)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(temporary_folder, folder)
+    print("Model saved to:", folder)
+
+
+def read_meta(folder):
+    """
+    Read the meta.json of a saved model.
+
+    Args:
+    - folder (str): Folder the model was saved to.
+
+    Returns:
+    - dict: The saved meta, or None if there is no saved model.
+    """
+    meta_file = os.path.join(folder, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as f:
+        return json.load(f)
+
+
+def load_model(folder, mmap=True):
+    """
+    Load a model saved with save_model.
+
+    With mmap=True the arrays are read-only memory maps, so every process
+    loading the same folder shares one copy through the page cache.
+
+    Args:
+    - folder (str): Folder the model was saved to.
+    - mmap (bool): Memory-map the arrays instead of reading them.
+
+    Returns:
+    - tuple: (arrays, meta) with arrays a dict of name -> numpy array.
+    """
+    meta = read_meta(folder)
+    if meta is None:
+        raise FileNotFoundError(f"No saved model in {folder}")
+    mmap_mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mmap_mode) for name in meta["arrays"]}
+    return arrays, meta
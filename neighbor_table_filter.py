@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class NeighborTableFilter:
+    """
+    Recommends songs by merging the precomputed neighbor lists of the seed tracks.
+
+    The table is built offline by build_neighbors.py. A candidate's score is the
+    sum of its similarity to each seed it neighbors.
+    """
+
+    def __init__(self, table_file):
+        table = np.load(table_file)
+        self.track_ids = table["track_ids"]
+        self.neighbors = table["neighbors"]
+        self.scores = table["scores"]
+        self.track_to_id = {track_id: i for i, track_id in enumerate(self.track_ids.tolist())}
+
+    def uris_to_ids(self, playlist):
+        return np.asarray([self.track_to_id[uri] for uri in playlist if uri in self.track_to_id], dtype=np.int64)
+
+    def recommend_songs(self, playlist, N):
+        return self.recommend_batch([playlist], N)[0]
+
+    def recommend_batch(self, playlists, N):
+        return [tracks.tolist() for tracks, _ in self.recommend_scored_batch(playlists, N)]
+
+    def recommend_scored(self, playlist, N):
+        return self.recommend_scored_batch([playlist], N)[0]
+
+    def recommend_scored_batch(self, playlists, N):
+        """
+        Like recommend_batch, with the merged scores: a (tracks, scores) pair of arrays per playlist, best first.
+        """
+        empty = (self.track_ids[:0], np.empty(0))
+        if N <= 0 or len(playlists) == 0:
+            return [empty for _ in playlists]
+
+        seed_lists = [self.uris_to_ids(playlist) for playlist in playlists]
+        seed_ids = np.concatenate(seed_lists)
+        seed_queries = np.repeat(np.arange(len(playlists)), [len(seeds) for seeds in seed_lists])
+        if len(seed_ids) == 0:
+            return [empty for _ in playlists]
+
+        # Merge the neighbor lists of every seed, keyed on (query, track)
+        n_tracks = len(self.track_ids)
+        neighbors = self.neighbors[seed_ids]
+        valid = neighbors >= 0
+        queries = np.broadcast_to(seed_queries[:, None], neighbors.shape)[valid]
+        keys, inverse = np.unique(queries * n_tracks + neighbors[valid], return_inverse=True)
+        totals = np.bincount(inverse, weights=self.scores[seed_ids][valid])
+
+        keep = ~np.isin(keys, seed_queries * n_tracks + seed_ids)
+        keys, totals = keys[keep], totals[keep]
+        queries, tracks = keys // n_tracks, keys % n_tracks
+
+        # Per query: highest merged score first, lower track id on ties
+        order = np.lexsort((tracks, -totals, queries))
+        queries, tracks, totals = queries[order], tracks[order], totals[order]
+        ranks = np.arange(len(queries)) - np.searchsorted(queries, queries)
+        top = ranks < N
+        bounds = np.searchsorted(queries[top], np.arange(1, len(playlists)))
+        return list(zip(np.split(self.track_ids[tracks[top]], bounds), np.split(totals[top], bounds)))
@@ -0,0 +1,161 @@
+import os
+from collections.abc import Sequence
+
+import numpy as np
+
+
+class PlaylistArrays:
+    """
+    Columnar, memory-mappable storage of a playlist set.
+
+    Track URIs are replaced by int32 ids into a vocabulary and the playlists
+    are stored CSR-style: the tracks of playlist i are
+    tracks[offsets[i]:offsets[i + 1]]. Every array is a plain .npy file in one
+    folder, so load() with mmap=True only maps the files instead of parsing them.
+    """
+
+    fields = ("vocabulary", "tracks", "offsets", "positions", "csv_indices", "pids", "names", "num_tracks")
+
+    def __init__(self, vocabulary, tracks, offsets, positions, csv_indices, pids, names, num_tracks):
+        self.vocabulary = vocabulary
+        self.tracks = tracks
+        self.offsets = offsets
+        self.positions = positions
+        self.csv_indices = csv_indices
+        self.pids = pids
+        self.names = names
+        self.num_tracks = num_tracks
+
+    @classmethod
+    def from_playlists(cls, playlists):
+        """
+        Convert playlist dicts, as stored in TestSet.json and EvalSet.json.
+        """
+        track_to_id = {}
+        tracks = []
+        positions = []
+        csv_indices = []
+        offsets = [0]
+        pids = []
+        names = []
+        num_tracks = []
+        for playlist in playlists:
+            for track in playlist["tracks"]:
+                tracks.append(track_to_id.setdefault(track["track_uri"], len(track_to_id)))
+                positions.append(track.get("pos", -1))
+                csv_indices.append(track.get("index_in_csv", -1))
+            offsets.append(len(tracks))
+            pids.append(playlist.get("pid", -1))
+            names.append(playlist.get("name", ""))
+            num_tracks.append(playlist.get("num_tracks", len(playlist["tracks"])))
+
+        return cls(np.asarray(list(track_to_id), dtype=str),
+                   np.asarray(tracks, dtype=np.int32),
+                   np.asarray(offsets, dtype=np.int64),
+                   np.asarray(positions, dtype=np.int32),
+                   np.asarray(csv_indices, dtype=np.int32),
+                   np.asarray(pids, dtype=np.int64),
+                   np.asarray(names, dtype=str),
+                   np.asarray(num_tracks, dtype=np.int32))
+
+    @classmethod
+    def concatenate(cls, parts, vocabulary):
+        """
+        Join playlist sets, in order, whose track ids all index vocabulary.
+        """
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for part in parts:
+            offsets.append(np.asarray(part.offsets[1:], dtype=np.int64) + offsets[-1][-1] - part.offsets[0])
+        columns = [np.concatenate([np.asarray(getattr(part, field)) for part in parts])
+                   for field in ("tracks", "positions", "csv_indices", "pids", "names", "num_tracks")]
+        tracks, positions, csv_indices, pids, names, num_tracks = columns
+        return cls(vocabulary, tracks, np.concatenate(offsets), positions, csv_indices, pids, names, num_tracks)
+
+    def select(self, rows):
+        """
+        Keep the playlists at rows, in that order, with the same vocabulary.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return PlaylistArrays(self.vocabulary, self.tracks[positions], offsets, self.positions[positions],
+                              self.csv_indices[positions], self.pids[rows], self.names[rows], self.num_tracks[rows])
+
+    def save(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        for field in self.fields:
+            np.save(os.path.join(folder, f"{field}.npy"), getattr(self, field))
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(folder, f"{field}.npy"), mmap_mode=mmap_mode) for field in cls.fields])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def track_uris(self, i):
+        return self.vocabulary[self.tracks[self.offsets[i]:self.offsets[i + 1]]].tolist()
+
+    def playlist(self, i):
+        """
+        Rebuild playlist i as the dict it was stored from.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        tracks = []
+        for uri, pos, csv_index in zip(self.vocabulary[self.tracks[start:end]].tolist(),
+                                       self.positions[start:end].tolist(), self.csv_indices[start:end].tolist()):
+            track = {"pos": pos, "track_uri": uri}
+            if csv_index >= 0:
+                track["index_in_csv"] = csv_index
+            tracks.append(track)
+        return {"name": str(self.names[i]), "pid": int(self.pids[i]), "num_tracks": int(self.num_tracks[i]), "tracks": tracks}
+
+    def to_data(self):
+        """
+        Dict with a lazy "playlists" sequence, usable wherever loaded JSON data is.
+        """
+        return {"playlists": PlaylistSequence(self)}
+
+
+def sort_vocabulary(vocabulary):
+    """
+    Order and sorted copy of a vocabulary for URI -> id lookups with lookup_vocabulary_ids.
+
+    Both are plain arrays, so filters can save them with their model and memory-map them.
+    """
+    vocabulary_order = np.argsort(vocabulary, kind="stable")
+    return vocabulary_order, vocabulary[vocabulary_order]
+
+
+def lookup_vocabulary_ids(vocabulary_order, sorted_vocabulary, uris):
+    """
+    Id of every uri in the vocabulary sorted by sort_vocabulary, -1 for uris not in it.
+    """
+    uris = np.asarray(uris, dtype=str)
+    ids = np.full(len(uris), -1, dtype=np.int64)
+    if len(uris) and len(sorted_vocabulary):
+        positions = np.minimum(np.searchsorted(sorted_vocabulary, uris), len(sorted_vocabulary) - 1)
+        known = sorted_vocabulary[positions] == uris
+        ids[known] = vocabulary_order[positions[known]]
+    return ids
+
+
+class PlaylistSequence(Sequence):
+    # Playlist dicts are built on access, so slicing off a few costs nothing up front
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.arrays.playlist(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("playlist index out of range")
+        return self.arrays.playlist(index)
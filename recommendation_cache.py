@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    """
+    On-disk cache of recommendation lists, shared between runs and processes.
+
+    Entries are keyed on the filter type, the fingerprint of the data it was
+    fitted on, the seed tracks and N, so a rebuilt model never serves stale
+    lists. Once more than max_entries are stored the least recently used
+    ones are evicted.
+    """
+
+    def __init__(self, file_path, max_entries=1000000):
+        self.file_path = file_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # SQLite connections must not cross a fork, each process opens its own
+        if self.connection is None or self.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+            self.connection = sqlite3.connect(self.file_path, timeout=60)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS recommendations "
+                                    "(key TEXT PRIMARY KEY, tracks TEXT NOT NULL, last_used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS recommendations_last_used ON recommendations (last_used)")
+            self.pid = os.getpid()
+        return self.connection
+
+    def __getstate__(self):
+        return {"file_path": self.file_path, "max_entries": self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state["file_path"], state["max_entries"])
+
+    @staticmethod
+    def model_key(recommender):
+        """
+        Identify a fitted filter, None when it has no fingerprint and cannot be cached.
+        """
+        fingerprint = getattr(recommender, "fingerprint", None)
+        if fingerprint is None:
+            return None
+        return [type(recommender).__name__, getattr(recommender, "aggregation", None), fingerprint]
+
+    @staticmethod
+    def entry_key(model_key, seeds, N):
+        return hashlib.sha256(json.dumps([model_key, list(seeds), N]).encode()).hexdigest()
+
+    def get_many(self, model_key, seed_lists, N):
+        """
+        Look up cached recommendation lists.
+
+        Args:
+        - model_key (list): Key of the filter, see model_key().
+        - seed_lists (list): Seed track lists.
+        - N (int): Number of recommended songs.
+
+        Returns:
+        - dict: Seed tuple -> recommendation list, for the seed lists that were cached.
+        """
+        keys = {self.entry_key(model_key, seeds, N): tuple(seeds) for seeds in seed_lists}
+        connection = self.connect()
+        found = {}
+        key_list = list(keys)
+        # Stay below SQLite's bound parameter limit
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start:start + 500]
+            rows = connection.execute(f"SELECT key, tracks FROM recommendations WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, tracks in rows:
+                found[key] = json.loads(tracks)
+        if found:
+            with connection:
+                connection.executemany("UPDATE recommendations SET last_used = ? WHERE key = ?",
+                                       [(time.time(), key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return {keys[key]: tracks for key, tracks in found.items()}
+
+    def put_many(self, model_key, recommendations, N):
+        """
+        Store recommendation lists and evict the least recently used entries over max_entries.
+
+        Args:
+        - model_key (list): Key of the filter, see model_key().
+        - recommendations (dict): Seed tuple -> recommendation list.
+        - N (int): Number of recommended songs.
+
+        Returns:
+        - None
+        """
+        now = time.time()
+        connection = self.connect()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO recommendations (key, tracks, last_used) VALUES (?, ?, ?)",
+                                   [(self.entry_key(model_key, seeds, N), json.dumps(tracks), now)
+                                    for seeds, tracks in recommendations.items()])
+            count = connection.execute("SELECT COUNT(*) FROM recommendations").fetchone()[0]
+            if count > self.max_entries:
+                connection.execute("DELETE FROM recommendations WHERE key IN "
+                                   "(SELECT key FROM recommendations ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+
+    def recommend_batch(self, recommender, seed_lists, N):
+        """
+        Recommend N songs per seed list, computing only the lists that are not cached.
+
+        Args:
+        - recommender: Fitted filter with recommend_batch(playlists, N).
+        - seed_lists (list): Seed track lists.
+        - N (int): Number of recommended songs.
+
+        Returns:
+        - list: One recommendation list per seed list.
+        """
+        model_key = self.model_key(recommender)
+        if model_key is None:
+            return recommender.recommend_batch(seed_lists, N)
+
+        cached = self.get_many(model_key, seed_lists, N)
+        missing = list(dict.fromkeys(seeds for seeds in map(tuple, seed_lists) if seeds not in cached))
+        if missing:
+            computed = dict(zip(missing, recommender.recommend_batch([list(seeds) for seeds in missing], N)))
+            self.put_many(model_key, computed, N)
+            cached.update(computed)
+        return [cached[tuple(seeds)] for seeds in seed_lists]
+
+
+class LRUCache:
+    """
+    Bounded, thread-safe in-memory cache that evicts the least recently used entry first.
+
+    Bounded by max_entries and, when set, by max_bytes: the summed nbytes of
+    the arrays held in the entries, so entries of very different sizes such
+    as per-seed co-occurrence vectors stay within a memory budget.
+    hits and misses count the lookups made with get(), to help size the bounds.
+    """
+
+    def __init__(self, max_entries=100000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        # Locks cannot be pickled, a copy starts empty
+        return {"max_entries": self.max_entries, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_entries"], state.get("max_bytes"))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def size_of(value):
+        # Bytes of the arrays in a value or a tuple of values; other parts are small and not counted
+        parts = value if isinstance(value, (tuple, list)) else (value,)
+        return sum(getattr(part, "nbytes", 0) for part in parts)
+
+    def get(self, key, accept=None):
+        # An entry failing accept(value), e.g. too short a list, is a miss and is left for put() to replace
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and accept is not None and not accept(value):
+                value = None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.bytes += self.size_of(value) - self.sizes.get(key, 0)
+            self.sizes[key] = self.size_of(value)
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            # An entry larger than max_bytes on its own is evicted right away
+            while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.bytes > self.max_bytes):
+                evicted, _ = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "bytes": self.bytes,
+                    "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
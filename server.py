@@ -0,0 +1,242 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+import numpy as np
+
+from sparse_user_based_filter import SparseUserBasedFilter
+from item_based_filter import ItemBasedFilter
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests to one filter into batches for its recommend_batch.
+
+    A batch runs once it holds max_batch_size requests, or max_wait seconds
+    after the first of them arrived. Scoring runs in a worker thread so the
+    event loop keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, recommender, max_batch_size=64, max_wait=0.005):
+        self.recommender = recommender
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = deque()
+        self.arrived = asyncio.Event()
+        self.batch_sizes = deque(maxlen=100000)
+
+    async def recommend(self, seeds, N):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((seeds, N, future))
+        self.arrived.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.arrived.wait()
+            deadline = loop.time() + self.max_wait
+            while len(self.pending) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch_size))]
+            if self.pending:
+                self.arrived.set()
+            else:
+                self.arrived.clear()
+            self.batch_sizes.append(len(batch))
+            await self.run_batch(batch)
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        # recommend_batch takes one N, so requests are grouped by it
+        requests_by_n = {}
+        for seeds, N, future in batch:
+            requests_by_n.setdefault(N, []).append((seeds, future))
+
+        for N, requests in requests_by_n.items():
+            try:
+                results = await loop.run_in_executor(None, self.recommender.recommend_batch, [seeds for seeds, _ in requests], N)
+            except Exception as error:
+                for _, future in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, future), result in zip(requests, results):
+                # The client may have gone away
+                if not future.done():
+                    future.set_result(result)
+
+
+class ServerStats:
+    """
+    Latency and throughput of the last window of requests.
+    """
+
+    def __init__(self, window=100000):
+        self.completions = deque(maxlen=window)
+        self.requests = 0
+        self.start_time = time.perf_counter()
+
+    def record(self, latency):
+        self.completions.append((time.perf_counter(), latency))
+        self.requests += 1
+
+    def report(self, interval=None):
+        """
+        Summarize the requests completed in the last interval seconds, or in the whole window if None.
+        """
+        now = time.perf_counter()
+        since = self.start_time if interval is None else now - interval
+        latencies = np.asarray([latency for finished, latency in self.completions if finished >= since]) * 1000
+        elapsed = max(now - max(since, self.start_time), 1e-9)
+        report = {"requests": self.requests, "window_requests": len(latencies), "throughput": len(latencies) / elapsed}
+        if len(latencies):
+            report.update(p50_ms=float(np.percentile(latencies, 50)), p99_ms=float(np.percentile(latencies, 99)),
+                          mean_ms=float(latencies.mean()))
+        return report
+
+
+def http_response(status, payload):
+    body = json.dumps(payload).encode()
+    head = f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+    return head.encode() + body
+
+
+async def read_request(reader):
+    # Minimal HTTP/1.1: request line, headers and a Content-Length body
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+class RecommendationServer:
+    """
+    Serves recommendations from filters loaded once, over HTTP on TCP or a unix socket.
+
+    POST /recommend with {"tracks": [...], "n": 40, "filter": "user"} returns
+    {"tracks": [...]}; GET /stats returns latency percentiles, throughput and
+    batch sizes.
+    """
+
+    def __init__(self, filters, max_batch_size=64, max_wait=0.005, report_interval=10):
+        self.batchers = {name: MicroBatcher(recommender, max_batch_size, max_wait) for name, recommender in filters.items()}
+        self.stats = ServerStats()
+        self.report_interval = report_interval
+
+    async def handle_request(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            return "200 OK", self.stats_report()
+        if method != "POST" or path != "/recommend":
+            return "404 Not Found", {"error": f"Unknown endpoint {method} {path}"}
+        try:
+            request = json.loads(body)
+            seeds = [str(track) for track in request["tracks"]]
+            N = int(request.get("n", 40))
+            batcher = self.batchers[request.get("filter", "user")]
+        except (ValueError, KeyError, TypeError) as error:
+            return "400 Bad Request", {"error": f"Invalid request: {error!r}"}
+        return "200 OK", {"tracks": await batcher.recommend(seeds, N)}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                start_time = time.perf_counter()
+                try:
+                    status, payload = await self.handle_request(method, path, body)
+                except Exception as error:
+                    status, payload = "500 Internal Server Error", {"error": repr(error)}
+                writer.write(http_response(status, payload))
+                await writer.drain()
+                if path == "/recommend":
+                    self.stats.record(time.perf_counter() - start_time)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def stats_report(self, interval=None):
+        report = self.stats.report(interval)
+        for name, batcher in self.batchers.items():
+            if batcher.batch_sizes:
+                report[f"{name}_mean_batch_size"] = float(np.mean(batcher.batch_sizes))
+        return report
+
+    async def report_periodically(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            report = self.stats_report(self.report_interval)
+            if report["window_requests"]:
+                print(f"{report['window_requests']} requests in {self.report_interval} s, "
+                      f"{report['throughput']:.1f} req/s, p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms")
+
+    async def serve(self, host="127.0.0.1", port=8000, unix_socket_path=None):
+        tasks = [asyncio.create_task(batcher.run()) for batcher in self.batchers.values()]
+        tasks.append(asyncio.create_task(self.report_periodically()))
+        if unix_socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket_path)
+            print("Serving on", unix_socket_path)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"Serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+# Saved models, see main.py
+user_model_folder = "models/user_based"
+item_model_folder = "models/item_based"
+host = "127.0.0.1"
+port = 8000
+# Set to a path to listen on a unix socket instead of TCP
+unix_socket_path = None
+max_batch_size = 64
+max_wait = 0.005
+report_interval = 10
+seed_cache_entries = 100000
+seed_cache_bytes = 1 << 30
+
+
+def main():
+    start_time = time.time()
+    # Memory-mapped once for the lifetime of the server
+    filters = {"user": SparseUserBasedFilter.load(user_model_folder), "item": ItemBasedFilter.load(item_model_folder)}
+    if seed_cache_entries:
+        for recommender in filters.values():
+            recommender.enable_seed_cache(seed_cache_entries, seed_cache_bytes)
+    print(f"Models loaded in {time.time() - start_time:.4f} seconds")
+
+    server = RecommendationServer(filters, max_batch_size, max_wait, report_interval)
+    asyncio.run(server.serve(host, port, unix_socket_path))
+
+
+if __name__ == "__main__":
+    main()
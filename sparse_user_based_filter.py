@@ -0,0 +1,489 @@
+import hashlib
+
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix
+
+from model_store import load_model, save_model
+from playlist_arrays import PlaylistArrays, lookup_vocabulary_ids, sort_vocabulary
+from recommendation_cache import LRUCache
+
+
+def expand_ranges(indptr, ids):
+    """
+    Concatenate the index ranges indptr[i]:indptr[i + 1] for every i in ids.
+
+    Returns the concatenated positions and, for each position, the index into
+    ids it came from.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    starts = indptr[ids]
+    lengths = indptr[ids + 1] - starts
+    owners = np.repeat(np.arange(len(ids)), lengths)
+    positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return positions, owners
+
+
+def count_matrices(tracks, indptr, n_tracks):
+    """
+    Playlist x track count matrix as CSR, whose rows score playlists, and CSC, whose columns list the playlists of a track.
+    """
+    counts = np.ones(len(tracks), dtype=np.int32)
+    # Copies, since sum_duplicates sorts the index arrays in place
+    matrix = csr_matrix((counts, np.array(tracks, dtype=np.int32), np.array(indptr, dtype=np.int64)), shape=(len(indptr) - 1, n_tracks))
+    matrix.sum_duplicates()
+    matrix_csc = matrix.tocsc()
+    matrix_csc.sort_indices()
+    return matrix, matrix_csc
+
+
+class SparseUserBasedFilter:
+    """
+    User-based filter backed by a scipy.sparse playlist x track count matrix.
+
+    Produces the same rankings as UserBasedFilter, which stays the reference
+    implementation: a track's score is the number of times it occurs in the
+    playlists shared with the seeds, ties keep the order in which the
+    reference would first meet the track.
+
+    Playlists can be added and removed without a rebuild, see add_playlists().
+    """
+
+    seed_cache = None
+    # Optional instrumentation.Profiler for recommend_batch
+    profiler = None
+    # Compact once the added and removed playlists outnumber this share of the base, None to only compact on request
+    compaction_ratio = 0.25
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Loaded JSON data, or PlaylistArrays which need no conversion
+        if isinstance(data, PlaylistArrays):
+            self._data = data.to_data()
+            self.build_matrix(data)
+        else:
+            self._data = data
+            self.build_matrix(PlaylistArrays.from_playlists(data["playlists"]))
+
+    def build_matrix(self, arrays):
+        self.playlist_arrays = arrays
+        self.vocabulary = arrays.vocabulary
+        self.vocabulary_order, self.sorted_vocabulary = sort_vocabulary(self.vocabulary)
+
+        # Playlist tracks in their original order, needed for tie-breaking
+        self.playlist_tracks = np.asarray(arrays.tracks, dtype=np.int32)
+        self.playlist_indptr = np.asarray(arrays.offsets, dtype=np.int64)
+
+        self.matrix, self.matrix_csc = count_matrices(self.playlist_tracks, self.playlist_indptr, len(self.vocabulary))
+        self.reset_updates()
+
+    def reset_updates(self):
+        # Playlists added since the last compaction with their matrices, ids of their
+        # tracks missing from the base vocabulary, and the rows still in use
+        self.added_arrays = None
+        self.added_matrix = None
+        self.added_matrix_csc = None
+        self.extra_track_ids = {}
+        self.active = None
+        self.base_fingerprint = None
+        if self.seed_cache is not None:
+            self.seed_cache.clear()
+
+    def save(self, folder):
+        """
+        Save the fitted matrices so other processes can memory-map them with load().
+
+        Added and removed playlists are compacted first.
+        """
+        self.compact()
+        arrays = {f"playlist_{field}": getattr(self.playlist_arrays, field) for field in PlaylistArrays.fields}
+        arrays.update(vocabulary_order=self.vocabulary_order, sorted_vocabulary=self.sorted_vocabulary)
+        for name, matrix in (("matrix", self.matrix), ("matrix_csc", self.matrix_csc)):
+            arrays.update({f"{name}_data": matrix.data, f"{name}_indices": matrix.indices, f"{name}_indptr": matrix.indptr})
+        save_model(folder, arrays, {"model": type(self).__name__, "shape": list(self.matrix.shape),
+                                    "fingerprint": getattr(self, "fingerprint", None)})
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Load a filter saved with save(), without rebuilding anything.
+        """
+        arrays, meta = load_model(folder, mmap)
+        user_based_filter = cls.__new__(cls)
+        playlist_arrays = PlaylistArrays(*[arrays[f"playlist_{field}"] for field in PlaylistArrays.fields])
+        user_based_filter._data = playlist_arrays.to_data()
+        user_based_filter.playlist_arrays = playlist_arrays
+        user_based_filter.vocabulary = playlist_arrays.vocabulary
+        user_based_filter.vocabulary_order = arrays["vocabulary_order"]
+        user_based_filter.sorted_vocabulary = arrays["sorted_vocabulary"]
+        user_based_filter.playlist_tracks = playlist_arrays.tracks
+        user_based_filter.playlist_indptr = playlist_arrays.offsets
+        shape = tuple(meta["shape"])
+        user_based_filter.matrix = csr_matrix((arrays["matrix_data"], arrays["matrix_indices"], arrays["matrix_indptr"]), shape=shape)
+        user_based_filter.matrix_csc = csc_matrix((arrays["matrix_csc_data"], arrays["matrix_csc_indices"], arrays["matrix_csc_indptr"]), shape=shape)
+        user_based_filter.reset_updates()
+        user_based_filter.fingerprint = meta["fingerprint"]
+        return user_based_filter
+
+    def lookup_ids(self, uris):
+        # Id of every uri, -1 for uris neither in the vocabulary nor added since
+        ids = lookup_vocabulary_ids(self.vocabulary_order, self.sorted_vocabulary, uris)
+        if self.extra_track_ids:
+            for i in np.flatnonzero(ids < 0).tolist():
+                ids[i] = self.extra_track_ids.get(str(uris[i]), -1)
+        return ids
+
+    def uris_to_ids(self, playlist):
+        ids = self.lookup_ids(playlist)
+        return ids[ids >= 0]
+
+    def add_playlists(self, playlists):
+        """
+        Add playlists without rebuilding the base matrices.
+
+        The added playlists get their own small matrices that every query merges
+        with the base ones, until compact() folds them in. Rankings are the same
+        as those of a filter built from the current playlists followed by the
+        added ones. data keeps returning the playlists of the last build or
+        compaction.
+
+        Args:
+        - playlists (list or PlaylistArrays): Playlist dicts, as stored in EvalSet.json, or their arrays.
+
+        Returns:
+        - None
+        """
+        self.add_arrays(playlists if isinstance(playlists, PlaylistArrays) else PlaylistArrays.from_playlists(playlists))
+        self.updated()
+
+    def add_arrays(self, arrays):
+        track_ids = self.lookup_ids(arrays.vocabulary)
+        # Tracks not seen before are appended to the vocabulary
+        new_uris = list(dict.fromkeys(arrays.vocabulary[track_ids < 0].tolist()))
+        if new_uris:
+            first_id = len(self.vocabulary)
+            self.extra_track_ids.update(zip(new_uris, range(first_id, first_id + len(new_uris))))
+            self.vocabulary = np.concatenate((self.vocabulary, np.asarray(new_uris, dtype=str)))
+            track_ids = self.lookup_ids(arrays.vocabulary)
+
+        added = PlaylistArrays(self.vocabulary, track_ids[arrays.tracks].astype(np.int32), arrays.offsets, arrays.positions,
+                               arrays.csv_indices, arrays.pids, arrays.names, arrays.num_tracks)
+        parts = [added] if self.added_arrays is None else [self.added_arrays, added]
+        self.added_arrays = PlaylistArrays.concatenate(parts, self.vocabulary)
+        self.added_matrix, self.added_matrix_csc = count_matrices(self.added_arrays.tracks, self.added_arrays.offsets, len(self.vocabulary))
+        if self.active is not None:
+            self.active = np.concatenate((self.active, np.ones(len(added), dtype=bool)))
+
+    def remove_playlists(self, pids):
+        """
+        Remove playlists by pid without rebuilding the matrices; they are dropped for good by compact().
+
+        Args:
+        - pids (iterable): Pids of the playlists to remove.
+
+        Returns:
+        - int: Number of playlists removed.
+        """
+        all_pids = np.asarray(self.playlist_arrays.pids)
+        if self.added_arrays is not None:
+            all_pids = np.concatenate((all_pids, self.added_arrays.pids))
+        if self.active is None:
+            self.active = np.ones(len(all_pids), dtype=bool)
+        removed = self.active & np.isin(all_pids, np.fromiter(pids, dtype=np.int64))
+        self.active &= ~removed
+        self.updated()
+        return int(removed.sum())
+
+    def updated(self):
+        if self.seed_cache is not None:
+            self.seed_cache.clear()
+        # A new fingerprint, so caches keyed on it (see recommendation_cache) never serve lists of the old playlists
+        if self.base_fingerprint is None:
+            self.base_fingerprint = getattr(self, "fingerprint", None)
+        if self.base_fingerprint is not None:
+            digest = hashlib.sha256(self.base_fingerprint.encode())
+            if self.added_arrays is not None:
+                for array in (self.vocabulary[self.matrix.shape[1]:], self.added_arrays.tracks, self.added_arrays.offsets):
+                    digest.update(np.ascontiguousarray(array).tobytes())
+            if self.active is not None:
+                digest.update(self.active.tobytes())
+            self.fingerprint = digest.hexdigest()
+
+        pending = 0 if self.added_arrays is None else len(self.added_arrays)
+        if self.active is not None:
+            pending += int((~self.active).sum())
+        if self.compaction_ratio is not None and pending > self.compaction_ratio * max(self.matrix.shape[0], 1):
+            self.compact()
+
+    def compact(self):
+        """
+        Fold the added playlists into the base matrices and drop the removed ones, a full rebuild.
+        """
+        if self.added_arrays is None and self.active is None:
+            return
+        parts = [self.playlist_arrays] if self.added_arrays is None else [self.playlist_arrays, self.added_arrays]
+        playlists = PlaylistArrays.concatenate(parts, self.vocabulary)
+        if self.active is not None:
+            playlists = playlists.select(np.flatnonzero(self.active))
+        fingerprint = getattr(self, "fingerprint", None)
+        self._data = playlists.to_data()
+        self.build_matrix(playlists)
+        self.fingerprint = fingerprint
+
+    def save_snapshot(self, folder):
+        """
+        Save only the updates since the last compaction, a fraction of the size of save().
+
+        load_snapshot() replays them onto the saved base model they were made on.
+        """
+        arrays = {}
+        if self.added_arrays is not None:
+            # The added playlists with a vocabulary of just their own tracks
+            used, tracks = np.unique(self.added_arrays.tracks, return_inverse=True)
+            added = PlaylistArrays(self.vocabulary[used], tracks.astype(np.int32), self.added_arrays.offsets, self.added_arrays.positions,
+                                   self.added_arrays.csv_indices, self.added_arrays.pids, self.added_arrays.names, self.added_arrays.num_tracks)
+            arrays.update({f"added_{field}": getattr(added, field) for field in PlaylistArrays.fields})
+        if self.active is not None:
+            arrays["active"] = self.active
+        base_fingerprint = self.base_fingerprint if self.base_fingerprint is not None else getattr(self, "fingerprint", None)
+        save_model(folder, arrays, {"model": type(self).__name__, "base_playlists": self.matrix.shape[0],
+                                    "base_fingerprint": base_fingerprint})
+
+    def load_snapshot(self, folder):
+        """
+        Replay a snapshot saved with save_snapshot() onto the base model it was made on.
+        """
+        arrays, meta = load_model(folder, mmap=False)
+        if self.added_arrays is not None or self.active is not None:
+            raise ValueError("Cannot load a snapshot on top of pending updates, load the base model first")
+        if meta["base_playlists"] != self.matrix.shape[0] or meta["base_fingerprint"] != getattr(self, "fingerprint", None):
+            raise ValueError(f"Snapshot in {folder} was made on a different base model")
+        if "added_tracks" in arrays:
+            self.add_arrays(PlaylistArrays(*[arrays[f"added_{field}"] for field in PlaylistArrays.fields]))
+        if "active" in arrays:
+            self.active = arrays["active"]
+        self.updated()
+
+    def get_shared_playlist_ids(self, seed_ids):
+        # One entry per (seed, playlist) pair, in the order the reference visits them
+        positions, _ = expand_ranges(self.matrix_csc.indptr, seed_ids)
+        return self.matrix_csc.indices[positions]
+
+    def first_seen(self, playlist_ids):
+        """
+        Position at which each track is first met when walking the shared playlists.
+        """
+        positions, _ = expand_ranges(self.playlist_indptr, playlist_ids)
+        stream = self.playlist_tracks[positions]
+        first = np.full(len(self.vocabulary), len(stream), dtype=np.int64)
+        tracks, first_positions = np.unique(stream, return_index=True)
+        first[tracks] = first_positions
+        return first
+
+    def score_tracks(self, seed_ids):
+        playlist_ids = self.get_shared_playlist_ids(seed_ids)
+        weights = np.bincount(playlist_ids, minlength=self.matrix.shape[0])
+        # Weighted row-sum of the shared playlists
+        scores = self.matrix.T.dot(weights)
+        return scores, playlist_ids
+
+    def top_n(self, scores, first, exclude, N):
+        scores = scores.astype(np.int64)
+        scores[exclude] = 0
+        candidates = np.flatnonzero(scores)
+        if N <= 0 or len(candidates) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        # Higher score first, then earlier first occurrence
+        key = scores[candidates] * (first.max() + 1) - first[candidates]
+        if N < len(candidates):
+            top = np.argpartition(-key, N - 1)[:N]
+        else:
+            top = np.arange(len(candidates))
+        return candidates[top[np.argsort(-key[top], kind="stable")]]
+
+    def enable_seed_cache(self, max_entries=100000, max_bytes=1 << 30):
+        """
+        Cache the co-occurrence counts of each seed track, merged per playlist at query time.
+
+        Popular seeds are shared by many playlists, their counts are then only
+        computed once. A popular seed's counts span a large part of the
+        vocabulary, so the cache is also bounded by the bytes it holds.
+        self.seed_cache.stats() reports hits, misses and bytes.
+        """
+        self.seed_cache = LRUCache(max_entries, max_bytes)
+        return self
+
+    def recommend_songs(self, playlist, N):
+        if self.seed_cache is not None or self.added_arrays is not None or self.active is not None:
+            return self.recommend_batch([playlist], N)[0]
+        seed_ids = self.uris_to_ids(playlist)
+        scores, playlist_ids = self.score_tracks(seed_ids)
+        first = self.first_seen(playlist_ids)
+
+        recommended_ids = self.top_n(scores, first, seed_ids, N)
+        return self.vocabulary[recommended_ids].tolist()
+
+    def segments(self):
+        # (first playlist row, CSR, CSC, tracks, indptr) of the base playlists and of the added ones
+        segments = [(0, self.matrix, self.matrix_csc, self.playlist_tracks, self.playlist_indptr)]
+        if self.added_arrays is not None:
+            segments.append((self.matrix.shape[0], self.added_matrix, self.added_matrix_csc,
+                             self.added_arrays.tracks, self.added_arrays.offsets))
+        return segments
+
+    def co_occurrences(self, seed_ids, seed_queries, n_queries):
+        """
+        Count the tracks of the playlists shared with each query's seeds.
+
+        Returns (queries, tracks, counts, first) sorted by query and track, where
+        first is the position at which the reference first meets the track in the
+        query's stream of shared playlists, and the length of each query's stream.
+        """
+        segments = self.segments()
+        n_tracks = len(self.vocabulary)
+
+        # (seed, playlist) pairs in the order the reference walks them: per seed, base playlists then added ones
+        pair_seeds, playlist_ids, pair_segments = [], [], []
+        for segment, (first_row, _, matrix_csc, _, _) in enumerate(segments):
+            seeds = np.flatnonzero(seed_ids < matrix_csc.shape[1])
+            positions, owners = expand_ranges(matrix_csc.indptr, seed_ids[seeds])
+            pair_seeds.append(seeds[owners])
+            playlist_ids.append(matrix_csc.indices[positions] + first_row)
+            pair_segments.append(np.full(len(positions), segment))
+        pair_seeds, playlist_ids, pair_segments = map(np.concatenate, (pair_seeds, playlist_ids, pair_segments))
+        if len(segments) > 1:
+            order = np.argsort(pair_seeds, kind="stable")
+            pair_seeds, playlist_ids, pair_segments = pair_seeds[order], playlist_ids[order], pair_segments[order]
+        if self.active is not None:
+            active = self.active[playlist_ids]
+            pair_seeds, playlist_ids, pair_segments = pair_seeds[active], playlist_ids[active], pair_segments[active]
+        playlist_queries = seed_queries[pair_seeds]
+
+        scores = None
+        pair_lengths = np.empty(len(playlist_ids), dtype=np.int64)
+        segment_pairs = []
+        for segment, (first_row, matrix, _, _, indptr) in enumerate(segments):
+            pairs = np.flatnonzero(pair_segments == segment)
+            rows = playlist_ids[pairs] - first_row
+            segment_pairs.append((pairs, rows))
+            pair_lengths[pairs] = indptr[rows + 1] - indptr[rows]
+
+            weights = csr_matrix((np.ones(len(rows), dtype=np.int32), (playlist_queries[pairs], rows)), shape=(n_queries, matrix.shape[0]))
+            product = weights.dot(matrix)
+            product = csr_matrix((product.data, product.indices, product.indptr), shape=(n_queries, n_tracks))
+            scores = product if scores is None else scores + product
+        scores.sort_indices()
+
+        # The stream of shared playlist tracks, each pair's tracks placed at its position in the walk
+        pair_starts = np.cumsum(pair_lengths) - pair_lengths
+        stream = np.empty(pair_lengths.sum(), dtype=np.int64)
+        for (_, _, _, tracks, indptr), (pairs, rows) in zip(segments, segment_pairs):
+            positions, owners = expand_ranges(indptr, rows)
+            stream[pair_starts[pairs][owners] + positions - indptr[rows][owners]] = \
+                playlist_queries[pairs][owners] * n_tracks + tracks[positions]
+
+        # First occurrence per (query, track), ordered like the nonzeros of scores
+        _, first = np.unique(stream, return_index=True)
+        stream_lengths = np.bincount(playlist_queries, weights=pair_lengths, minlength=n_queries).astype(np.int64)
+        stream_starts = np.cumsum(stream_lengths) - stream_lengths
+
+        queries = np.repeat(np.arange(n_queries), np.diff(scores.indptr))
+        return queries, scores.indices, scores.data, first - stream_starts[queries], stream_lengths
+
+    def cached_co_occurrences(self, seed_ids, seed_queries):
+        # Same result as co_occurrences, merged from per-seed entries of self.seed_cache
+        entries = {}
+        missing = []
+        for seed in dict.fromkeys(seed_ids.tolist()):
+            entries[seed] = self.seed_cache.get(seed)
+            if entries[seed] is None:
+                missing.append(seed)
+        if missing:
+            # Every missing seed as its own query, in one sparse product
+            queries, tracks, counts, first, stream_lengths = self.co_occurrences(np.asarray(missing, dtype=np.int64),
+                                                                                 np.arange(len(missing)), len(missing))
+            bounds = np.searchsorted(queries, np.arange(len(missing) + 1))
+            for i, seed in enumerate(missing):
+                part = slice(bounds[i], bounds[i + 1])
+                entries[seed] = (tracks[part].copy(), counts[part].copy(), first[part].copy(), int(stream_lengths[i]))
+                self.seed_cache.put(seed, entries[seed])
+
+        parts = [entries[seed] for seed in seed_ids.tolist()]
+        sizes = [len(part[0]) for part in parts]
+        stream_lengths = np.asarray([part[3] for part in parts], dtype=np.int64)
+        # A seed's stream follows the streams of the earlier seeds of its playlist
+        stream_starts = np.cumsum(stream_lengths) - stream_lengths
+        stream_starts -= stream_starts[np.searchsorted(seed_queries, seed_queries)]
+
+        n_tracks = len(self.vocabulary)
+        keys, inverse = np.unique(np.repeat(seed_queries, sizes) * n_tracks + np.concatenate([part[0] for part in parts]),
+                                  return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([part[1] for part in parts]), minlength=len(keys)).astype(np.int64)
+        first = np.full(len(keys), np.iinfo(np.int64).max)
+        np.minimum.at(first, inverse, np.concatenate([part[2] for part in parts]) + np.repeat(stream_starts, sizes))
+        return keys // n_tracks, keys % n_tracks, counts, first
+
+    def recommend_batch(self, playlists, N):
+        """
+        Recommend N songs for each playlist, scoring all of them with one sparse product.
+
+        Returns the same lists as calling recommend_songs once per playlist.
+        """
+        return [tracks.tolist() for tracks, _ in self.recommend_scored_batch(playlists, N)]
+
+    def recommend_scored(self, playlist, N):
+        return self.recommend_scored_batch([playlist], N)[0]
+
+    def recommend_scored_batch(self, playlists, N):
+        """
+        Like recommend_batch, with the scores: a (tracks, scores) pair of arrays per playlist, best first.
+
+        A track's score is its number of occurrences in the playlists shared with the seeds.
+        """
+        empty = (self.vocabulary[:0], np.empty(0))
+        if N <= 0 or len(playlists) == 0:
+            return [empty for _ in playlists]
+
+        timer = self.profiler.timer("sparse_user_based") if self.profiler is not None else None
+        seed_lists = [self.uris_to_ids(playlist) for playlist in playlists]
+        seed_ids = np.concatenate(seed_lists)
+        seed_queries = np.repeat(np.arange(len(playlists)), [len(seeds) for seeds in seed_lists])
+        if timer is not None:
+            timer.lap("seed_lookup", playlists=len(playlists), seeds=len(seed_ids))
+
+        if len(seed_ids) == 0:
+            return [empty for _ in playlists]
+        if self.seed_cache is not None:
+            queries, tracks, counts, first = self.cached_co_occurrences(seed_ids, seed_queries)
+        else:
+            queries, tracks, counts, first, _ = self.co_occurrences(seed_ids, seed_queries, len(playlists))
+        if timer is not None:
+            timer.lap("counting", candidates=len(tracks))
+
+        n_tracks = len(self.vocabulary)
+        keep = ~np.isin(queries * n_tracks + tracks, seed_queries * n_tracks + seed_ids)
+        queries, tracks, counts, first = queries[keep], tracks[keep], counts[keep], first[keep]
+        if timer is not None:
+            timer.lap("exclusion")
+
+        # Per query: higher score first, then earlier first occurrence
+        order = np.lexsort((first, -counts, queries))
+        queries, tracks, counts = queries[order], tracks[order], counts[order]
+        row_starts = np.searchsorted(queries, np.arange(len(playlists)))
+        ranks = np.arange(len(queries)) - row_starts[queries]
+        queries, tracks, counts = queries[ranks < N], tracks[ranks < N], counts[ranks < N]
+        if timer is not None:
+            timer.lap("sorting")
+
+        bounds = np.searchsorted(queries, np.arange(1, len(playlists)))
+        recommended = list(zip(np.split(self.vocabulary[tracks], bounds), np.split(counts.astype(np.float64), bounds)))
+        if timer is not None:
+            timer.finish("output", recommended=len(tracks))
+        return recommended
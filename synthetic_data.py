@@ -0,0 +1,214 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from playlist_arrays import PlaylistArrays
+
+track_id_alphabet = np.array(list("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"))
+genres = [f"genre {i}" for i in range(114)]
+
+
+def zipf_names(rng, count, name_count):
+    """
+    Draw playlist names with a Zipfian distribution, as names collide heavily in the MPD.
+
+    Args:
+    - rng (numpy.random.Generator): Random generator to draw from.
+    - count (int): Number of names to draw.
+    - name_count (int): Number of distinct names.
+
+    Returns:
+    - numpy.ndarray: Names.
+    """
+    return np.asarray([f"playlist {i}" for i in rng.zipf(1.3, count) % name_count], dtype=str)
+
+
+class SyntheticMPD:
+    """
+    Deterministic stand-in for the Million Playlist Dataset and the song CSV.
+
+    Playlists draw their tracks from a universe of track_count tracks with
+    Zipfian popularity: the track of rank r is picked with probability
+    proportional to 1 / (r + 1) ** zipf_exponent. The defaults put the most
+    popular track in about 5% of the playlists and give geometric playlist
+    lengths averaging 66 tracks, close to the MPD. A catalog_share of the
+    universe is in the song catalog, like the MPD tracks found in the 90k set.
+    Every slice has its own random stream, so a slice is the same whichever
+    others are generated, and slices past playlist_count give held-out playlists.
+    """
+
+    def __init__(self, playlist_count, track_count=500000, catalog_share=0.3, length_min=5, length_mean=66, length_max=250,
+                 zipf_exponent=0.5, name_count=20000, playlists_per_slice=1000, seed=0):
+        self.playlist_count = playlist_count
+        self.track_count = track_count
+        self.catalog_share = catalog_share
+        self.length_min = length_min
+        self.length_mean = length_mean
+        self.length_max = length_max
+        self.zipf_exponent = zipf_exponent
+        self.name_count = name_count
+        self.playlists_per_slice = playlists_per_slice
+        self.seed = seed
+
+        rng = np.random.default_rng([seed, 0])
+        self.track_ids = track_id_alphabet[rng.integers(0, len(track_id_alphabet), (track_count, 22))].view("<U22").ravel()
+        popularity = 1 / np.arange(1, track_count + 1) ** zipf_exponent
+        self.track_cdf = np.cumsum(popularity / popularity.sum())
+        # Row of each universe track in the catalog, -1 if it is not in it
+        in_catalog = rng.random(track_count) < catalog_share
+        self.catalog_rows = np.where(in_catalog, np.cumsum(in_catalog) - 1, -1)
+        self.catalog_tracks = np.flatnonzero(in_catalog)
+
+    def config(self):
+        return {"playlist_count": self.playlist_count, "track_count": self.track_count, "catalog_share": self.catalog_share,
+                "length_min": self.length_min, "length_mean": self.length_mean, "length_max": self.length_max, "zipf_exponent": self.zipf_exponent,
+                "name_count": self.name_count, "playlists_per_slice": self.playlists_per_slice, "seed": self.seed}
+
+    def slice_count(self):
+        return -(-self.playlist_count // self.playlists_per_slice)
+
+    def slice_tracks(self, index, count=None):
+        """
+        Generate slice index as arrays.
+
+        Args:
+        - index (int): Slice number, slices past slice_count() are held out.
+        - count (int): Number of playlists, playlists_per_slice if None.
+
+        Returns:
+        - tuple: (tracks, offsets, pids, names) with tracks universe ranks, CSR-style.
+        """
+        if count is None:
+            last_count = self.playlist_count - (self.slice_count() - 1) * self.playlists_per_slice
+            count = last_count if index == self.slice_count() - 1 else self.playlists_per_slice
+        rng = np.random.default_rng([self.seed, 1, index])
+        lengths = np.minimum(self.length_min - 1 + rng.geometric(1 / (self.length_mean - self.length_min + 1), count), self.length_max)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        tracks = np.minimum(np.searchsorted(self.track_cdf, rng.random(offsets[-1]), side="right"), self.track_count - 1)
+        names = zipf_names(rng, count, self.name_count)
+        pids = index * self.playlists_per_slice + np.arange(count, dtype=np.int64)
+        return tracks, offsets, pids, names
+
+    def mpd_slice(self, index):
+        """
+        Slice index as the dict stored in an MPD slice file.
+        """
+        tracks, offsets, pids, names = self.slice_tracks(index)
+        playlists = []
+        for i in range(len(pids)):
+            playlist_tracks = []
+            for pos, rank in enumerate(tracks[offsets[i]:offsets[i + 1]].tolist()):
+                playlist_tracks.append({"pos": pos, "artist_name": f"Artist {rank % 5000}", "track_uri": f"spotify:track:{self.track_ids[rank]}",
+                                        "artist_uri": f"spotify:artist:{rank % 5000}", "track_name": f"Track {rank}",
+                                        "album_uri": f"spotify:album:{rank % 20000}", "duration_ms": 180000 + rank % 120000,
+                                        "album_name": f"Album {rank % 20000}"})
+            playlists.append({"name": str(names[i]), "collaborative": "false", "pid": int(pids[i]), "modified_at": 1500000000,
+                              "num_tracks": len(playlist_tracks), "num_albums": len(playlist_tracks), "num_followers": 1,
+                              "tracks": playlist_tracks, "num_edits": 1, "duration_ms": 0, "num_artists": len(playlist_tracks)})
+        first_pid = index * self.playlists_per_slice
+        return {"info": {"generated_on": "synthetic", "slice": f"{first_pid}-{first_pid + self.playlists_per_slice - 1}", "version": "v1"},
+                "playlists": playlists}
+
+    def write_slices(self, folder):
+        """
+        Write the playlists as MPD slice files, mpd.slice.<first pid>-<last pid>.json.
+
+        Returns:
+        - list: Paths of the written files.
+        """
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for index in range(self.slice_count()):
+            data = self.mpd_slice(index)
+            path = os.path.join(folder, f"mpd.slice.{data['info']['slice']}.json")
+            with open(path, 'w') as f:
+                json.dump(data, f)
+            paths.append(path)
+        return paths
+
+    def catalog(self):
+        """
+        The catalog as a csv_filtered.csv-style DataFrame, one row per catalog track.
+        """
+        rng = np.random.default_rng([self.seed, 2])
+        ranks = self.catalog_tracks
+        count = len(ranks)
+        return pd.DataFrame({
+            "track_id": self.track_ids[ranks],
+            "artists": [f"Artist {rank % 5000}" for rank in ranks.tolist()],
+            "album_name": [f"Album {rank % 20000}" for rank in ranks.tolist()],
+            "track_name": [f"Track {rank}" for rank in ranks.tolist()],
+            "popularity": np.maximum(0, 100 - np.log2(ranks + 1) * 5).astype(int),
+            "duration_ms": 180000 + ranks % 120000,
+            "explicit": rng.random(count) < 0.1,
+            "danceability": rng.random(count).round(3),
+            "energy": rng.random(count).round(3),
+            "key": rng.integers(0, 12, count),
+            "loudness": (-30 * rng.random(count)).round(3),
+            "mode": rng.integers(0, 2, count),
+            "speechiness": (rng.random(count) ** 3).round(4),
+            "acousticness": rng.random(count).round(4),
+            "instrumentalness": (rng.random(count) ** 4).round(5),
+            "liveness": rng.random(count).round(4),
+            "valence": rng.random(count).round(3),
+            "tempo": (60 + 140 * rng.random(count)).round(3),
+            "time_signature": rng.integers(3, 6, count),
+            "track_genre": np.asarray(genres)[rng.integers(0, len(genres), count)],
+        })
+
+    def write_catalog(self, csv_path):
+        os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+        # The index is written as the unnamed first column, as in csv_filtered.csv
+        self.catalog().to_csv(csv_path)
+
+    def playlist_arrays(self, first_slice=0, slice_count=None, playlist_length_minimum=10):
+        """
+        Playlists as load.py leaves them in EvalSet.json, built without writing JSON.
+
+        Only catalog tracks are kept, and playlists shorter than
+        playlist_length_minimum before or after matching are dropped, as in
+        load.process_slice. Track ids index the catalog rows.
+
+        Args:
+        - first_slice (int): First slice to include.
+        - slice_count (int): Number of slices, up to slice_count() if None.
+        - playlist_length_minimum (int): Minimum length of playlists to keep.
+
+        Returns:
+        - PlaylistArrays: The playlists, in slice order.
+        """
+        if slice_count is None:
+            slice_count = self.slice_count() - first_slice
+        parts = []
+        for index in range(first_slice, first_slice + slice_count):
+            tracks, offsets, pids, names = self.slice_tracks(index)
+            rows = self.catalog_rows[tracks]
+            matched = rows >= 0
+            owners = np.repeat(np.arange(len(pids)), np.diff(offsets))
+            matched_counts = np.bincount(owners[matched], minlength=len(pids))
+            keep = (np.diff(offsets) >= playlist_length_minimum) & (matched_counts >= playlist_length_minimum)
+            kept = matched & keep[owners]
+            positions = np.arange(len(tracks)) - offsets[owners]
+            parts.append(PlaylistArrays(None, rows[kept].astype(np.int32),
+                                        np.concatenate(([0], np.cumsum(matched_counts[keep]))).astype(np.int64),
+                                        positions[kept].astype(np.int32), rows[kept].astype(np.int32), pids[keep],
+                                        names[keep], np.diff(offsets)[keep].astype(np.int32)))
+        return PlaylistArrays.concatenate(parts, self.track_ids[self.catalog_tracks])
+
+
+# Writes a synthetic data/completedataset and csv_filtered.csv for load.py
+playlist_count = 10000
+output_folder = "data/synthetic"
+
+
+def main():
+    dataset = SyntheticMPD(playlist_count)
+    paths = dataset.write_slices(os.path.join(output_folder, "completedataset"))
+    dataset.write_catalog(os.path.join(output_folder, "csv_filtered.csv"))
+    print(f"{len(paths)} slices and {len(dataset.catalog_tracks)} catalog tracks written to {output_folder}")
+
+
+if __name__ == "__main__":
+    main()
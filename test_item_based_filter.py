@@ -0,0 +1,56 @@
+import io
+import json
+import zipfile
+
+import pandas as pd
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from item_based_filter import ItemBasedFilter
+
+# The bundled final_data, read from the zip so the tests need no extracted copy
+data_zip = "final_data-1000.zip"
+N = 40
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    with zipfile.ZipFile(data_zip) as archive:
+        return pd.read_csv(io.BytesIO(archive.read("final_data/csv_filtered.csv")))
+
+
+@pytest.fixture(scope="module")
+def playlists():
+    # The first 1 and 5 tracks of 300 test and eval playlists, as main.py seeds them
+    with zipfile.ZipFile(data_zip) as archive:
+        json_data = [json.loads(archive.read(f"final_data/{name}.json")) for name in ("TestSet", "EvalSet")]
+    playlists = (json_data[0]["playlists"] + json_data[1]["playlists"])[:300]
+    return [[track["track_uri"] for track in playlist["tracks"]][:n] for playlist in playlists for n in (1, 5)]
+
+
+@pytest.mark.parametrize("aggregation", ItemBasedFilter.aggregations)
+def test_batch_matches_single(catalog, playlists, aggregation):
+    item_based_filter = ItemBasedFilter(catalog, aggregation=aggregation)
+    assert item_based_filter.recommend_batch(playlists, N) == [item_based_filter.recommend_songs(playlist, N) for playlist in playlists]
+
+
+def test_first_matches_dataframe_lookup(catalog, playlists):
+    # The DataFrame-based recommend_songs the feature matrix replaced: neighbors of the first seed in the song data
+    nearest_neighbors = NearestNeighbors(n_neighbors=50, algorithm='auto', metric='cosine').fit(catalog[ItemBasedFilter.default_features])
+    item_based_filter = ItemBasedFilter(catalog)
+    for playlist in playlists:
+        input_features = catalog[catalog['track_id'].isin(playlist)][ItemBasedFilter.default_features]
+        _, indices = nearest_neighbors.kneighbors(input_features)
+        expected = [song for song in catalog.iloc[indices[0]]['track_id'].tolist() if song not in playlist][:N]
+        assert item_based_filter.recommend_songs(playlist, N) == expected
+
+
+@pytest.mark.parametrize("aggregation", ItemBasedFilter.aggregations)
+def test_seed_cache_is_transparent(catalog, playlists, aggregation):
+    item_based_filter = ItemBasedFilter(catalog, aggregation=aggregation)
+    expected = item_based_filter.recommend_batch(playlists, N)
+    item_based_filter.enable_seed_cache()
+    # A cold pass, a warm pass and single calls served from lists fetched for other k
+    assert item_based_filter.recommend_batch(playlists, N) == expected
+    assert item_based_filter.recommend_batch(playlists, N) == expected
+    assert [item_based_filter.recommend_songs(playlist, N) for playlist in playlists] == expected
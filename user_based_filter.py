@@ -1,20 +1,143 @@
+import numpy as np
+
+from model_store import load_model, save_model
+from playlist_arrays import PlaylistArrays
+
+
 class UserBasedFilter:
-    data = ""
+    # Optional instrumentation.Profiler for recommend_songs
+    profiler = None
 
     def __init__(self, data):
         self.data = data
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # Assigning new data rebuilds the inverted index; in-place edits of the
+        # playlists dict are not tracked, call build_index() after those.
+        if isinstance(data, PlaylistArrays):
+            self._data = data.to_data()
+            self.build_index_from_arrays(data)
+        else:
+            self._data = data
+            self.build_index()
+        # Ids of removed playlists, which stay in data until compact()
+        self.removed = set()
+
+    def build_index(self):
+        """
+        Build the inverted index track_uri -> sorted int32 array of playlist ids.
+
+        Playlist ids are positions in self.data["playlists"], so looking them up
+        gives the same playlists, in the same order, as a full scan.
+        """
+        postings = {}
+        if self._data:
+            for playlist_id, playlist in enumerate(self._data["playlists"]):
+                for track in playlist["tracks"]:
+                    ids = postings.setdefault(track["track_uri"], [])
+                    # a playlist is listed once even if it repeats the track
+                    if not ids or ids[-1] != playlist_id:
+                        ids.append(playlist_id)
+        self.track_index = {uri: np.asarray(ids, dtype=np.int32) for uri, ids in postings.items()}
+
+    def build_index_from_arrays(self, arrays):
+        # Same index as build_index, computed from the CSR arrays without touching playlist dicts
+        playlist_ids = np.repeat(np.arange(len(arrays), dtype=np.int32), np.diff(arrays.offsets))
+        order = np.lexsort((playlist_ids, arrays.tracks))
+        tracks, playlist_ids = arrays.tracks[order], playlist_ids[order]
+        first = np.ones(len(tracks), dtype=bool)
+        first[1:] = (tracks[1:] != tracks[:-1]) | (playlist_ids[1:] != playlist_ids[:-1])
+        tracks, playlist_ids = tracks[first], playlist_ids[first]
+        bounds = np.flatnonzero(np.diff(tracks)) + 1
+        uris = arrays.vocabulary[tracks[np.concatenate(([0], bounds))]].tolist() if len(tracks) else []
+        self.track_index = dict(zip(uris, np.split(playlist_ids, bounds)))
+
+    def add_playlists(self, playlists):
+        """
+        Append playlists to data and add them to the inverted index in place.
+        """
+        stored = self._data["playlists"]
+        if not isinstance(stored, list):
+            # Playlists built on access from arrays, appending needs a list
+            stored = self._data["playlists"] = list(stored)
+        # New postings collected per track first, so each posting array is copied once per call
+        postings = {}
+        for playlist in playlists:
+            playlist_id = len(stored)
+            stored.append(playlist)
+            for uri in dict.fromkeys(track["track_uri"] for track in playlist["tracks"]):
+                postings.setdefault(uri, []).append(playlist_id)
+        for uri, ids in postings.items():
+            new_ids = np.asarray(ids, dtype=np.int32)
+            self.track_index[uri] = np.concatenate((self.track_index[uri], new_ids)) if uri in self.track_index else new_ids
+
+    def remove_playlists(self, pids):
+        """
+        Drop playlists by pid from the inverted index in place; compact() removes them from data.
+
+        Returns the number of playlists removed.
+        """
+        pids = set(pids)
+        removed = [playlist_id for playlist_id, playlist in enumerate(self._data["playlists"])
+                   if playlist.get("pid") in pids and playlist_id not in self.removed]
+        touched = set()
+        for playlist_id in removed:
+            touched.update(track["track_uri"] for track in self._data["playlists"][playlist_id]["tracks"])
+        for uri in touched:
+            playlist_ids = self.track_index[uri]
+            self.track_index[uri] = playlist_ids[~np.isin(playlist_ids, removed)]
+        self.removed.update(removed)
+        return len(removed)
+
+    def compact(self):
+        # Rebuild data and the index without the removed playlists
+        if self.removed:
+            self.data = {"playlists": [playlist for playlist_id, playlist in enumerate(self._data["playlists"])
+                                       if playlist_id not in self.removed]}
+
+    def save(self, folder):
+        """
+        Save the playlists and the inverted index so other processes can memory-map them with load().
+        """
+        self.compact()
+        playlists = self._data["playlists"]
+        playlist_arrays = playlists.arrays if hasattr(playlists, "arrays") else PlaylistArrays.from_playlists(playlists)
+        arrays = {f"playlist_{field}": getattr(playlist_arrays, field) for field in PlaylistArrays.fields}
+        uris = list(self.track_index)
+        postings = [self.track_index[uri] for uri in uris]
+        arrays.update(index_uris=np.asarray(uris, dtype=str),
+                      index_offsets=np.concatenate(([0], np.cumsum([len(ids) for ids in postings]))).astype(np.int64),
+                      index_playlists=np.concatenate(postings or [np.empty(0)]).astype(np.int32))
+        save_model(folder, arrays, {"model": type(self).__name__, "fingerprint": getattr(self, "fingerprint", None)})
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """
+        Load a filter saved with save(); the index entries are views into the mapped files.
+        """
+        arrays, meta = load_model(folder, mmap)
+        user_based_filter = cls.__new__(cls)
+        playlist_arrays = PlaylistArrays(*[arrays[f"playlist_{field}"] for field in PlaylistArrays.fields])
+        user_based_filter._data = playlist_arrays.to_data()
+        offsets = arrays["index_offsets"]
+        postings = np.split(arrays["index_playlists"], offsets[1:-1]) if len(offsets) > 1 else []
+        user_based_filter.track_index = dict(zip(arrays["index_uris"].tolist(), postings))
+        user_based_filter.removed = set()
+        user_based_filter.fingerprint = meta["fingerprint"]
+        return user_based_filter
+
     def id_to_uri(self, id):
         return "" + id
 
     def get_shared_playlists(self, track_id):
-        playlists = []
-        for playlist in self.data["playlists"]:
-            for track in playlist["tracks"]:
-                if track["track_uri"] == self.id_to_uri(track_id):
-                    playlists.append(playlist)
-                    break
-        return playlists
+        playlist_ids = self.track_index.get(self.id_to_uri(track_id), ())
+        playlists = self.data["playlists"]
+        return [playlists[i] for i in playlist_ids]
 
     def count_song_occurrences(self, playlists):
         song_counts = {}
@@ -26,13 +149,35 @@ class UserBasedFilter:
         return song_counts
 
     def recommend_songs(self, playlist, N):
+        return self.recommend_scored(playlist, N)[0].tolist()
+
+    def recommend_scored(self, playlist, N):
+        """
+        Recommended tracks with their scores, the number of times they occur in the shared playlists, as two arrays.
+        """
+        timer = self.profiler.timer("user_based") if self.profiler is not None else None
         shared_playlists = []
         for track_uri in playlist:
             shared_playlists.extend(self.get_shared_playlists(track_uri))
+        if timer is not None:
+            timer.lap("seed_lookup", seeds=len(playlist), shared_playlists=len(shared_playlists))
 
         song_counts = self.count_song_occurrences(shared_playlists)
+        if timer is not None:
+            timer.lap("counting", candidates=len(song_counts))
         sorted_songs = sorted(song_counts.items(), key=lambda item: item[1], reverse=True)
+        if timer is not None:
+            timer.lap("sorting")
 
-        recommended_songs = [song[0] for song in sorted_songs if song[0] not in playlist][:N]
+        recommended_songs = [song for song in sorted_songs if song[0] not in playlist][:N]
+        if timer is not None:
+            timer.finish("exclusion", recommended=len(recommended_songs))
         # print(f"Recommended songs: {recommended_songs}")
-        return recommended_songs
+        return (np.asarray([song[0] for song in recommended_songs], dtype=str),
+                np.asarray([song[1] for song in recommended_songs], dtype=np.float64))
+
+    def recommend_batch(self, playlists, N):
+        return [self.recommend_songs(playlist, N) for playlist in playlists]
+
+    def recommend_scored_batch(self, playlists, N):
+        return [self.recommend_scored(playlist, N) for playlist in playlists]